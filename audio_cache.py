@@ -0,0 +1,167 @@
+# ZundaGPT
+#
+# 合成音声キャッシュモジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+# 合成音声キャッシュ
+# メモリとディスクの２段構成で、どちらも容量を超えたら古く使われていないものから削除する
+class AudioCache:
+    # メモリ上に保持する最大サイズ（バイト）
+    MEMORY_CAPACITY = 32 * 1024 * 1024
+    FILE_EXT = ".wav"
+
+    def __init__(self, folder: str, capacity_mb: int):
+        self.folder = folder
+        self.capacity = max(capacity_mb, 0) * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._files = OrderedDict()
+        self._disk_size = 0
+        self._scan_folder()
+
+    # キャッシュのキーを作成する
+    @staticmethod
+    def make_key(engine: str, speaker_id, speed_scale, pitch_scale, engine_version, text: str) -> str:
+        source = json.dumps(
+            [engine, str(speaker_id), speed_scale, pitch_scale, engine_version, text], ensure_ascii=False)
+        return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+    # キャッシュが有効かどうか
+    def is_enabled(self) -> bool:
+        return self.capacity > 0
+
+    # キャッシュから音声データを取得する（見つからなければNone）
+    def get(self, key: str) -> bytes:
+        if not self.is_enabled():
+            return None
+
+        with self._lock:
+            wave_data = self._memory.get(key)
+            if wave_data is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return wave_data
+
+            if key in self._files:
+                wave_data = self._read_file(key)
+                if wave_data is not None:
+                    self._files.move_to_end(key)
+                    self._put_memory(key, wave_data)
+                    self.hits += 1
+                    return wave_data
+
+            self.misses += 1
+            return None
+
+    # 音声データをキャッシュに追加する
+    def put(self, key: str, wave_data: bytes):
+        if not self.is_enabled() or wave_data is None:
+            return
+
+        with self._lock:
+            self._put_memory(key, wave_data)
+            self._put_file(key, wave_data)
+
+    # 受信途中の音声データのチャンクをそのまま返しながら、最後まで受信できたらキャッシュに追加する
+    # 容量を超える大きさになったら、その時点でキャッシュへの追加をあきらめてメモリを解放する
+    def put_stream(self, key: str, chunks):
+        buffer = bytearray() if self.is_enabled() else None
+        for chunk in chunks:
+            if buffer is not None:
+                buffer.extend(chunk)
+                if len(buffer) > min(self.capacity, AudioCache.MEMORY_CAPACITY):
+                    buffer = None
+            yield chunk
+
+        if buffer is not None:
+            self.put(key, bytes(buffer))
+
+    # メモリキャッシュに追加する
+    def _put_memory(self, key, wave_data):
+        capacity = min(self.capacity, AudioCache.MEMORY_CAPACITY)
+        if len(wave_data) > capacity:
+            return
+
+        old_data = self._memory.pop(key, None)
+        if old_data is not None:
+            self._memory_size -= len(old_data)
+        self._memory[key] = wave_data
+        self._memory_size += len(wave_data)
+
+        while self._memory_size > capacity:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    # ディスクキャッシュに追加する
+    def _put_file(self, key, wave_data):
+        if self.folder == "" or len(wave_data) > self.capacity or key in self._files:
+            return
+
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            path = self._get_path(key)
+            temp_path = path + ".tmp"
+            with open(temp_path, "wb") as file:
+                file.write(wave_data)
+            os.replace(temp_path, path)
+        except OSError:
+            return
+
+        self._files[key] = len(wave_data)
+        self._disk_size += len(wave_data)
+        self._evict_files()
+
+    # ディスクキャッシュの容量を超えた分を削除する
+    def _evict_files(self):
+        while self._disk_size > self.capacity:
+            evicted_key, size = self._files.popitem(last=False)
+            self._disk_size -= size
+            try:
+                os.remove(self._get_path(evicted_key))
+            except OSError:
+                pass
+
+    # ディスクキャッシュから読み込む
+    def _read_file(self, key):
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as file:
+                wave_data = file.read()
+            os.utime(path)
+            return wave_data
+        except OSError:
+            self._disk_size -= self._files.pop(key)
+            return None
+
+    # キャッシュファイルのパスを取得する
+    def _get_path(self, key):
+        return os.path.join(self.folder, key + AudioCache.FILE_EXT)
+
+    # 既存のキャッシュファイルを最終使用日時順に読み込む
+    def _scan_folder(self):
+        if self.folder == "" or not os.path.isdir(self.folder):
+            return
+
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and entry.name.endswith(AudioCache.FILE_EXT):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-len(AudioCache.FILE_EXT)], stat.st_size))
+        entries.sort()
+
+        for _, key, size in entries:
+            self._files[key] = size
+            self._disk_size += size
+        self._evict_files()
@@ -0,0 +1,10 @@
+# ZundaGPT
+#
+# ベンチマークパッケージ
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+#
+# OpenAI、VOICEVOX、COEIROINKの代わりになるローカルのサーバーを立てて、会話のターンにかかる時間を計測する
+# リポジトリのルートで python -m benchmark として実行する
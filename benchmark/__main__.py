@@ -0,0 +1,11 @@
+# ZundaGPT
+#
+# ベンチマークのエントリーポイント
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+from benchmark.run import main
+
+main()
@@ -0,0 +1,309 @@
+# ZundaGPT
+#
+# ベンチマーク用の疑似サーバーモジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+import io
+import json
+import struct
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# 合成音声のサンプリングレート
+SAMPLE_RATE = 24000
+
+# 無音のWAVEデータを作成する（16bitモノラル）
+def make_wave(duration: float, rate: int = SAMPLE_RATE) -> bytes:
+    data_size = int(duration * rate) * 2
+    header = struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + data_size, b"WAVE",
+        b"fmt ", 16, 1, 1, rate, rate * 2, 2, 16,
+        b"data", data_size)
+    return header + bytes(data_size)
+
+# 疑似サーバーのリクエストハンドラー基底クラス
+# GETとPOSTをパスごとのメソッド（routesに登録する）に振り分ける
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # 応答のヘッダーと本体を分けて送るときに、Nagleアルゴリズムで待たされないようにする
+    disable_nagle_algorithm = True
+    # {(メソッド, パス): ハンドラーのメソッド名}
+    routes = {}
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    # アクセスログを出さない
+    def log_message(self, format, *args):
+        pass
+
+    # リクエストを振り分ける
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        self.query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length", 0))
+        self.body = self.rfile.read(length) if length > 0 else b""
+
+        handler = self.routes.get((method, url.path))
+        if handler is None:
+            self.send_json({"detail": "Not Found"}, 404)
+            return
+        try:
+            getattr(self, handler)()
+        except ConnectionError:
+            # 応答の途中でクライアントが切断した（回答の受信がキャンセルされたときなど）
+            self.close_connection = True
+
+    # 疑似サーバーの設定
+    @property
+    def owner(self) -> "FakeServer":
+        return self.server.owner
+
+    # リクエストのJSONを取得する
+    def read_json(self):
+        return json.loads(self.body) if self.body else {}
+
+    # JSONを返す
+    def send_json(self, value, status=200):
+        self.send_bytes(json.dumps(value, ensure_ascii=False).encode("utf-8"), "application/json", status)
+
+    # データを返す
+    def send_bytes(self, data: bytes, content_type: str, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+# 疑似サーバー基底クラス
+# 空いているポートでHTTPサーバーを立てて、バックグラウンドスレッドで応答する
+class FakeServer:
+    handler_class = FakeRequestHandler
+
+    def __init__(self):
+        self.request_count = 0
+        self._httpd = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # サーバーを開始する
+    def start(self) -> "FakeServer":
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class)
+        self._httpd.daemon_threads = True
+        self._httpd.owner = self
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    # サーバーを止める
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    # サーバーのURL
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    # リクエストの数を数える
+    def count_request(self):
+        with self._lock:
+            self.request_count += 1
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+# OpenAI互換のチャットAPIのリクエストハンドラー
+class FakeOpenAIHandler(FakeRequestHandler):
+    routes = {
+        ("POST", "/v1/chat/completions"): "chat_completions",
+    }
+
+    # チャットの応答を返す（streamが指定されていればSSEで少しずつ返す）
+    def chat_completions(self):
+        self.owner.count_request()
+        request = self.read_json()
+        messages = request.get("messages", [])
+        question = messages[-1]["content"] if len(messages) > 0 else ""
+        answer = self.owner.make_answer(question)
+        model = request.get("model", "fake")
+
+        time.sleep(self.owner.first_token_delay)
+        if not request.get("stream", False):
+            self.send_json({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": answer},
+                    "finish_reason": "stop"}],
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        self._send_chunk(model, {"role": "assistant", "content": ""}, None)
+        interval = 1 / self.owner.token_rate if self.owner.token_rate > 0 else 0
+        size = self.owner.chars_per_token
+        for offset in range(0, len(answer), size):
+            self._send_chunk(model, {"content": answer[offset:offset + size]}, None)
+            time.sleep(interval)
+        self._send_chunk(model, {}, "stop")
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    # SSEのイベントをひとつ送る
+    def _send_chunk(self, model, delta, finish_reason):
+        chunk = {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+# OpenAI互換のチャットAPIの疑似サーバー
+# 質問を含む決まった文章の回答を、指定した速さ（トークン/秒）で少しずつ返す
+class FakeOpenAIServer(FakeServer):
+    handler_class = FakeOpenAIHandler
+
+    ANSWER_SENTENCES = [
+        "それはいい質問なのだ。",
+        "ずんだもんが詳しく説明するのだ。",
+        "まずは基本から考えてみるのだ。",
+        "いろいろな見方があるけど、大事なのは続けることなのだ。",
+        "わからないことがあったら、また聞いてほしいのだ。",
+    ]
+
+    def __init__(self, token_rate: float = 50.0, first_token_delay: float = 0.3,
+                 answer_sentences: int = 5, chars_per_token: int = 2):
+        # token_rateは1秒あたりに返すトークン数（0なら待たない）、first_token_delayは最初のトークンまでの時間（秒）
+        super().__init__()
+        self.token_rate = token_rate
+        self.first_token_delay = first_token_delay
+        self.answer_sentences = answer_sentences
+        self.chars_per_token = chars_per_token
+
+    # 回答を作成する
+    def make_answer(self, question: str) -> str:
+        sentences = [f"「{question}」について答えるのだ。"]
+        for index in range(self.answer_sentences - 1):
+            sentences.append(FakeOpenAIServer.ANSWER_SENTENCES[index % len(FakeOpenAIServer.ANSWER_SENTENCES)])
+        return "".join(sentences)
+
+# 音声合成エンジンの疑似サーバー基底クラス
+# 合成には指定した時間をかけて、文字数に比例した長さの無音のWAVEデータを返す
+class FakeSpeechServer(FakeServer):
+    def __init__(self, synthesis_delay: float = 0.1, seconds_per_char: float = 0.12):
+        super().__init__()
+        self.synthesis_delay = synthesis_delay
+        self.seconds_per_char = seconds_per_char
+
+    # テキストを合成した音声データを作成する
+    def synthesize(self, text: str, speed_scale: float = 1.0) -> bytes:
+        self.count_request()
+        time.sleep(self.synthesis_delay)
+        return make_wave(len(text) * self.seconds_per_char / max(speed_scale, 0.1))
+
+# VOICEVOXのリクエストハンドラー
+class FakeVoicevoxHandler(FakeRequestHandler):
+    routes = {
+        ("GET", "/version"): "version",
+        ("POST", "/audio_query"): "audio_query",
+        ("POST", "/synthesis"): "synthesis",
+        ("POST", "/multi_synthesis"): "multi_synthesis",
+    }
+
+    def version(self):
+        self.send_json("0.0.0-fake")
+
+    # 読み上げ用データを返す（合成するテキストをkanaに入れておく）
+    def audio_query(self):
+        self.send_json({
+            "accent_phrases": [],
+            "speedScale": 1.0,
+            "pitchScale": 0.0,
+            "intonationScale": 1.0,
+            "volumeScale": 1.0,
+            "prePhonemeLength": 0.1,
+            "postPhonemeLength": 0.1,
+            "outputSamplingRate": SAMPLE_RATE,
+            "outputStereo": False,
+            "kana": self.query.get("text", ""),
+        })
+
+    def synthesis(self):
+        query_json = self.read_json()
+        self.send_bytes(self.owner.synthesize(query_json["kana"], query_json["speedScale"]), "audio/wav")
+
+    def multi_synthesis(self):
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, "w") as archive:
+            for index, query_json in enumerate(self.read_json()):
+                archive.writestr(f"{index + 1:03}.wav", self.owner.synthesize(query_json["kana"], query_json["speedScale"]))
+        self.send_bytes(output.getvalue(), "application/zip")
+
+# VOICEVOXの疑似サーバー
+class FakeVoicevoxServer(FakeSpeechServer):
+    handler_class = FakeVoicevoxHandler
+
+# COEIROINKのリクエストハンドラー
+class FakeCoeiroinkHandler(FakeRequestHandler):
+    routes = {
+        ("GET", "/"): "status",
+        ("GET", "/v1/engine_info"): "engine_info",
+        ("POST", "/v1/style_id_to_speaker_meta"): "style_id_to_speaker_meta",
+        ("POST", "/v1/estimate_prosody"): "estimate_prosody",
+        ("POST", "/v1/synthesis"): "synthesis",
+    }
+
+    def status(self):
+        self.send_json({"status": "Fake COEIROINK Engine is running."})
+
+    def engine_info(self):
+        self.send_json({"device": "CPU", "version": "0.0.0-fake"})
+
+    def style_id_to_speaker_meta(self):
+        self.send_json({
+            "speakerUuid": "00000000-0000-0000-0000-000000000000",
+            "styleId": int(self.query.get("styleId", 0)),
+        })
+
+    # 読み上げ用データを返す（1文字を1モーラとする）
+    def estimate_prosody(self):
+        text = self.read_json().get("text", "")
+        detail = [[{"phoneme": "a", "hira": char, "accent": 0} for char in text]]
+        self.send_json({"plain": [char for char in text], "detail": detail})
+
+    def synthesis(self):
+        request = self.read_json()
+        self.send_bytes(self.owner.synthesize(request["text"], request["speedScale"]), "audio/wav")
+
+# COEIROINKの疑似サーバー
+class FakeCoeiroinkServer(FakeSpeechServer):
+    handler_class = FakeCoeiroinkHandler
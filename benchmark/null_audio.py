@@ -0,0 +1,61 @@
+# ZundaGPT
+#
+# ベンチマーク用の音声出力モジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+import atexit
+import time
+
+from sound import AudioPlayer
+
+# 音を出さない出力ストリーム
+# realtimeがTrueなら、書き込んだ音声の長さだけ待って再生にかかる時間を再現する
+class NullStream:
+    def __init__(self, stream_format, realtime: bool):
+        sampwidth, channels, rate = stream_format
+        self._bytes_per_second = sampwidth * channels * rate
+        self._realtime = realtime
+        self.written_bytes = 0
+
+    def write(self, frames):
+        self.written_bytes += len(frames)
+        if self._realtime:
+            time.sleep(len(frames) / self._bytes_per_second)
+
+    def stop_stream(self):
+        pass
+
+    def close(self):
+        pass
+
+# 音を出さない音声再生クラス
+# PyAudioを使わないので、音声デバイスのない環境でも再生の流れをそのまま計測できる
+class NullAudioPlayer(AudioPlayer):
+    def __init__(self, realtime: bool = True):
+        self.realtime = realtime
+        super().__init__()
+
+    def _open_stream(self, stream_format):
+        if self._stream is not None and self._stream_format == stream_format:
+            return self._stream
+
+        self._close_stream()
+        self._stream = NullStream(stream_format, self.realtime)
+        self._stream_format = stream_format
+        return self._stream
+
+    def _init_audio(self):
+        pass
+
+# 共有のプレーヤーを音を出さないプレーヤーに置き換える
+def install(realtime: bool = True) -> NullAudioPlayer:
+    with AudioPlayer._instance_lock:
+        if AudioPlayer._instance is not None:
+            AudioPlayer._instance.close()
+        player = NullAudioPlayer(realtime)
+        AudioPlayer._instance = player
+        atexit.register(player.close)
+        return player
@@ -0,0 +1,161 @@
+# ZundaGPT
+#
+# ベンチマーク実行モジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import metrics
+from benchmark import null_audio
+from benchmark.fake_servers import FakeCoeiroinkServer, FakeOpenAIServer, FakeVoicevoxServer
+from character import CharacterCoeiroink, CharacterVoicevox
+from chat import Chat, ChatOpenAI
+from coeiroink_api import CoeiroinkApi
+from sentence_segmenter import SentenceSegmenter
+from speech_pipeline import SpeechPipeline
+from voicevox_api import VoicevoxAPI
+
+# 台本の質問（ターン数が多ければ繰り返す）
+SCRIPT = [
+    "こんにちは",
+    "今日の天気はどうかな",
+    "おすすめの本を教えて",
+    "プログラミングを始めるには何をすればいい",
+    "ずんだ餅の作り方を教えて",
+]
+
+# 表示する計測値の名前の順番（ターン全体を先に表示する）
+REPORT_ORDER = ["turn.", "chat.", "speech.", "voicevox.", "coeiroink.", "audio."]
+
+# コマンドライン引数を解析する
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmark", description="疑似サーバーを相手に会話のターンにかかる時間を計測する")
+    parser.add_argument("--turns", type=int, default=len(SCRIPT), help="会話のターン数")
+    parser.add_argument("--tts", choices=["VOICEVOX", "COEIROINK", "none"], default="VOICEVOX", help="読み上げに使う音声合成エンジン")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="チャットが1秒あたりに返すトークン数（0なら待たない）")
+    parser.add_argument("--first-token-delay", type=float, default=0.3, help="チャットが最初のトークンを返すまでの時間（秒）")
+    parser.add_argument("--answer-sentences", type=int, default=5, help="チャットの回答の文の数")
+    parser.add_argument("--synthesis-delay", type=float, default=0.1, help="音声合成にかかる時間（秒）")
+    parser.add_argument("--seconds-per-char", type=float, default=0.12, help="合成音声の1文字あたりの長さ（秒）")
+    parser.add_argument("--no-realtime", action="store_true", help="音声の長さだけ待たずに再生を終える")
+    parser.add_argument("--sync", action="store_true", help="非同期版ではなく同期版の送信処理を使う")
+    parser.add_argument("--json", metavar="FILE", help="計測結果をJSONL形式で追記するファイル")
+    return parser.parse_args(argv)
+
+# チャットを作成する（疑似サーバーに接続する）
+def create_chat(openai_server: FakeOpenAIServer, log_folder: str) -> Chat:
+    os.environ["OPENAI_API_KEY"] = "sk-benchmark"
+    os.environ["OPENAI_BASE_URL"] = f"{openai_server.url}/v1"
+    return ChatOpenAI("gpt-3.5-turbo", "あなたはずんだもんです。", "回答できませんでした。", 20, log_folder, SentenceSegmenter())
+
+# キャラクターを作成して、話者の準備が終わるまで待つ（読み上げないならNone）
+def create_character(tts: str, speech_server):
+    if tts == "VOICEVOX":
+        VoicevoxAPI.server = speech_server.url
+        character = CharacterVoicevox("", "3", 1.0, 0.0)
+    elif tts == "COEIROINK":
+        CoeiroinkApi.server = speech_server.url
+        character = CharacterCoeiroink("", "0", 1.0, 0.0)
+    else:
+        return None
+
+    if not character.wait_until_ready(character.STARTUP_TIMEOUT) or not character.monitor.is_up():
+        raise RuntimeError(f"{tts}の疑似サーバーに接続できませんでした")
+    return character
+
+# 台本の会話を行う（回答の文字数の合計を返す）
+async def run_script(chat: Chat, character, pipeline: SpeechPipeline, turns: int, sync: bool) -> int:
+    def outputChunk(chunk):
+        pass
+
+    def outputSentence(sentence):
+        metrics.mark_turn("turn.first_sentence")
+        if character is not None:
+            pipeline.enqueue(character, sentence, reply=True)
+
+    answer_chars = 0
+    for index in range(turns):
+        question = SCRIPT[index % len(SCRIPT)]
+        metrics.start_turn()
+        if sync:
+            answer = await asyncio.to_thread(chat.send_message, question, outputChunk, outputSentence)
+        else:
+            answer = await chat.send_message_async(question, outputChunk, outputSentence)
+        await asyncio.to_thread(pipeline.wait)
+        metrics.mark_turn("turn.total")
+        answer_chars += len(answer)
+    return answer_chars
+
+# 計測結果を表示する
+def print_report(summary: dict, results: dict):
+    print("計測値（ミリ秒、chat.tokens_per_secはトークン/秒）")
+    print()
+    print(f"  {'name':<28} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    names = sorted(summary, key=lambda name: (next(
+        (index for index, prefix in enumerate(REPORT_ORDER) if name.startswith(prefix)), len(REPORT_ORDER)), name))
+    for name in names:
+        values = summary[name]
+        if "p50" not in values:
+            continue
+        print(f"  {name:<28} {values['count']:>6} " +
+              " ".join(f"{values[key]:9.1f}" for key in ("p50", "p95", "p99", "max")))
+    print()
+    print(f"ターン数               : {results['turns']}")
+    print(f"経過時間（秒）         : {results['elapsed']:.2f}")
+    print(f"ターン/分              : {results['turns_per_minute']:.1f}")
+    print(f"回答の文字/秒          : {results['answer_chars_per_sec']:.1f}")
+    print(f"チャットのリクエスト数 : {results['chat_requests']}")
+    print(f"音声合成のリクエスト数 : {results['synthesis_requests']}")
+
+# ベンチマークを実行する
+def main(argv=None):
+    args = parse_args(argv)
+    # 疑似サーバーへの接続がプロキシを通らないようにする
+    os.environ["NO_PROXY"] = ",".join(filter(None, [os.environ.get("NO_PROXY"), "127.0.0.1"]))
+
+    null_audio.install(realtime=not args.no_realtime)
+    openai_server = FakeOpenAIServer(args.token_rate, args.first_token_delay, args.answer_sentences).start()
+    server_class = FakeCoeiroinkServer if args.tts == "COEIROINK" else FakeVoicevoxServer
+    speech_server = server_class(args.synthesis_delay, args.seconds_per_char).start()
+
+    try:
+        with tempfile.TemporaryDirectory() as log_folder:
+            chat = create_chat(openai_server, log_folder)
+            try:
+                character = create_character(args.tts, speech_server)
+                pipeline = SpeechPipeline()
+                # 話者の準備で合成した分は数えない
+                speech_server.request_count = 0
+                metrics.reset()
+
+                start = time.perf_counter()
+                answer_chars = asyncio.run(run_script(chat, character, pipeline, args.turns, args.sync))
+                elapsed = time.perf_counter() - start
+            finally:
+                chat.close()
+    finally:
+        openai_server.stop()
+        speech_server.stop()
+
+    results = {
+        "turns": args.turns,
+        "elapsed": elapsed,
+        "turns_per_minute": args.turns / elapsed * 60 if elapsed > 0 else 0,
+        "answer_chars_per_sec": answer_chars / elapsed if elapsed > 0 else 0,
+        "chat_requests": openai_server.request_count,
+        "synthesis_requests": speech_server.request_count,
+    }
+    print_report(metrics.summary(), results)
+
+    if args.json:
+        options = {key: value for key, value in vars(args).items() if key != "json"}
+        metrics.write_summary(args.json, options=options, results=results)
+        print()
+        print(f"計測結果を {args.json} に追記しました")
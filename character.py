@@ -8,87 +8,223 @@
 
 import os
 import subprocess
-import time
-
-import clr
-import psutil
+import threading
 
+from audio_cache import AudioCache
+from engine_monitor import EngineMonitor
+from sentence_segmenter import SentenceSegmenter
 from settings import Settings
-from sound import play_sound
+from sound import play_sound, stop_sound
+from speech_engine import SpeechEngine
 from voicevox_api import VoicevoxAPI
 from coeiroink_api import CoeiroinkApi
 
+# 音声合成エンジンの準備のために合成する文
+WARM_UP_TEXT = "あ"
+
 # キャラクターファクトリ
 class CharacterFactory:
+    # キャラクターが共有する合成音声キャッシュ
+    audio_cache: AudioCache = None
+
     # アシスタントキャラクターを作成する
     @staticmethod
     def create_assistant_character(settings: Settings):
-        tts_software = settings.get_assistant_tts_software()
-        if tts_software == "VOICEVOX":
-            return CharacterVoicevox(
-                settings.get_voicevox_path(),
-                settings.get_assistant_speaker_id(),
-                settings.get_assistant_speed_scale(),
-                settings.get_assistant_pitch_scale())
-        elif tts_software == "AIVOICE":
-            return CharacterAIVoice(
-                settings.get_aivoice_path(),
-                settings.get_assistant_speaker_id())
-        elif tts_software == "COEIROINK":
-            return CharacterCoeiroink(
-                settings.get_coeiroink_path(),
-                settings.get_assistant_speaker_id(),
-                settings.get_assistant_speed_scale(),
-                settings.get_assistant_pitch_scale())
-        else:
-            return None
+        return CharacterFactory._create_character(
+            settings,
+            settings.get_assistant_tts_software(),
+            settings.get_assistant_speaker_id(),
+            settings.get_assistant_speed_scale(),
+            settings.get_assistant_pitch_scale())
 
     # ユーザーキャラクターを作成する
     @staticmethod
     def create_user_character(settings: Settings):
-        tts_software = settings.get_user_tts_software()
+        return CharacterFactory._create_character(
+            settings,
+            settings.get_user_tts_software(),
+            settings.get_user_speaker_id(),
+            settings.get_user_speed_scale(),
+            settings.get_user_pitch_scale())
+
+    # アシスタントキャラクターを設定に合わせて変更する（変更したキャラクターを返す）
+    @staticmethod
+    def update_assistant_character(character, settings: Settings):
+        return CharacterFactory._update_character(
+            character,
+            settings,
+            settings.get_assistant_tts_software(),
+            settings.get_assistant_speaker_id(),
+            settings.get_assistant_speed_scale(),
+            settings.get_assistant_pitch_scale())
+
+    # ユーザーキャラクターを設定に合わせて変更する（変更したキャラクターを返す）
+    @staticmethod
+    def update_user_character(character, settings: Settings):
+        return CharacterFactory._update_character(
+            character,
+            settings,
+            settings.get_user_tts_software(),
+            settings.get_user_speaker_id(),
+            settings.get_user_speed_scale(),
+            settings.get_user_pitch_scale())
+
+    # キャラクターを作成する
+    @staticmethod
+    def _create_character(settings: Settings, tts_software, speaker_id, speed_scale, pitch_scale):
         if tts_software == "VOICEVOX":
             return CharacterVoicevox(
                 settings.get_voicevox_path(),
-                settings.get_user_speaker_id(),
-                settings.get_user_speed_scale(),
-                settings.get_user_pitch_scale())
+                speaker_id,
+                speed_scale,
+                pitch_scale,
+                CharacterFactory.audio_cache,
+                settings.get_sentence_min_length(),
+                settings.get_sentence_max_length())
         elif tts_software == "AIVOICE":
             return CharacterAIVoice(
                 settings.get_aivoice_path(),
-                settings.get_user_speaker_id())
+                speaker_id)
         elif tts_software == "COEIROINK":
             return CharacterCoeiroink(
                 settings.get_coeiroink_path(),
-                settings.get_user_speaker_id(),
-                settings.get_user_speed_scale(),
-                settings.get_user_pitch_scale())
+                speaker_id,
+                speed_scale,
+                pitch_scale,
+                CharacterFactory.audio_cache)
         else:
             return None
 
+    # キャラクターの声を変更する
+    # 読み上げソフトが同じならキャラクターをそのまま使い、違うときだけ作りなおす
+    @staticmethod
+    def _update_character(character, settings: Settings, tts_software, speaker_id, speed_scale, pitch_scale):
+        if character is not None and character.TTS_SOFTWARE == tts_software:
+            character.update(speaker_id, speed_scale, pitch_scale)
+            return character
+        return CharacterFactory._create_character(settings, tts_software, speaker_id, speed_scale, pitch_scale)
+
 # VOICEVOXキャラクター
 class CharacterVoicevox:
-    DEFAULT_INSTALL_PATH = "%LOCALAPPDATA%/Programs/VOICEVOX/VOICEVOX.exe"
+    TTS_SOFTWARE = "VOICEVOX"
+    # 起動を待つ最大時間（秒）
+    STARTUP_TIMEOUT = 10
 
-    def __init__(self, voicevox_path, speaker_id, speed_scale, pitch_scale):
+    def __init__(self, voicevox_path, speaker_id, speed_scale, pitch_scale, audio_cache: AudioCache = None,
+                 sentence_min_length=SentenceSegmenter.DEFAULT_MIN_LENGTH, sentence_max_length=SentenceSegmenter.DEFAULT_MAX_LENGTH):
         self.voicevox_path = voicevox_path
+        self.audio_cache = audio_cache
+        self.sentence_min_length = sentence_min_length
+        self.sentence_max_length = sentence_max_length
+        self.engine = CharacterVoicevox.get_engine(self.voicevox_path)
+        self.monitor = self.engine.monitor
+        self.update(speaker_id, speed_scale, pitch_scale)
+
+    # 声を変更する（エンジンとの接続はそのまま使う）
+    def update(self, speaker_id, speed_scale, pitch_scale):
         self.speaker_id = speaker_id
         self.speed_scale = speed_scale
         self.pitch_scale = pitch_scale
-        CharacterVoicevox.run_voicevox(self.voicevox_path)
+        self._ready = self.engine.prepare(speaker_id)
 
     # 話す
     def talk(self, text):
-        CharacterVoicevox.run_voicevox(self.voicevox_path)
-        query_json = VoicevoxAPI.audio_query(text, self.speaker_id)
-        query_json["speedScale"] = self.speed_scale
-        query_json["pitchScale"] = self.pitch_scale
-        wave_data = VoicevoxAPI.synthesis(query_json, self.speaker_id)
-        play_sound(wave_data)
+        self.play(self.synthesize(text, stream=True))
+
+    # 音声データを合成する
+    # streamがTrueなら、受信しながら再生できるようにWAVEデータのチャンクを返すイテレータを返す
+    def synthesize(self, text, stream=False):
+        self._ready.wait()
+        cache_key = self._get_cache_key(text)
+        if cache_key is not None:
+            wave_data = self.audio_cache.get(cache_key)
+            if wave_data is not None:
+                return wave_data
+
+        if not self.monitor.is_up():
+            return None
+
+        sentences = self.split_sentences(text)
+        try:
+            if len(sentences) > 1:
+                wave_data = VoicevoxAPI.synthesis_batch(sentences, self.speaker_id, self.speed_scale, self.pitch_scale)
+                stream = False
+            else:
+                query_json = VoicevoxAPI.audio_query(text, self.speaker_id)
+                query_json["speedScale"] = self.speed_scale
+                query_json["pitchScale"] = self.pitch_scale
+                wave_data = VoicevoxAPI.synthesis(query_json, self.speaker_id, stream)
+        except Exception:
+            self.monitor.request_check()
+            raise
+
+        if cache_key is not None:
+            if stream:
+                return self.audio_cache.put_stream(cache_key, wave_data)
+            self.audio_cache.put(cache_key, wave_data)
+        return wave_data
+
+    # 準備ができるまで待つ（準備ができていればTrue）
+    def wait_until_ready(self, timeout=None) -> bool:
+        return self._ready.wait(timeout)
+
+    # 複数の文からなるテキストを文ごとに分ける（チャットの回答と同じ文の長さの設定で分ける）
+    def split_sentences(self, text):
+        segmenter = SentenceSegmenter(self.sentence_min_length, self.sentence_max_length)
+        sentences = [sentence for _, sentence in segmenter.feed(text) if sentence is not None]
+        sentence = segmenter.flush()
+        if sentence is not None:
+            sentences.append(sentence)
+        return sentences
+
+    # 合成音声キャッシュのキーを取得する（キャッシュを使わない場合はNone）
+    def _get_cache_key(self, text):
+        if self.audio_cache is None or not self.audio_cache.is_enabled():
+            return None
+        engine_version = self.engine.get_version()
+        if engine_version is None:
+            return None
+        return AudioCache.make_key(
+            "VOICEVOX", self.speaker_id, self.speed_scale, self.pitch_scale, engine_version, text)
+
+    # 合成した音声データを再生する
+    def play(self, wave_data):
+        if wave_data is not None:
+            play_sound(wave_data)
+
+    # 再生中の音声を止める
+    def stop(self):
+        stop_sound()
+
+    # VOICEVOXのエンジンを取得する（キャラクターで共有する）
+    @staticmethod
+    def get_engine(voicevox_path) -> SpeechEngine:
+        return SpeechEngine.get("VOICEVOX", lambda: SpeechEngine(
+            CharacterVoicevox.start_monitor(voicevox_path),
+            CharacterVoicevox.STARTUP_TIMEOUT,
+            CharacterVoicevox.warm_up_speaker,
+            lambda: VoicevoxAPI.get_version(print_error=False)))
+
+    # 話者の準備のために短い文を合成する
+    @staticmethod
+    def warm_up_speaker(speaker_id):
+        query_json = VoicevoxAPI.audio_query(WARM_UP_TEXT, speaker_id)
+        VoicevoxAPI.synthesis(query_json, speaker_id)
+
+    # VOICEVOXの監視を開始する
+    @staticmethod
+    def start_monitor(voicevox_path) -> EngineMonitor:
+        return EngineMonitor.start(
+            "VOICEVOX",
+            lambda: VoicevoxAPI.get_version(print_error=False) is not None,
+            lambda: CharacterVoicevox.run_voicevox(voicevox_path))
 
     # VOICEVOXが起動しているかどうかを調べる
+    # psutilは起動を遅くするので、使うときに読み込む
     @staticmethod
     def is_voicevox_running():
+        import psutil
+
         for process in psutil.process_iter(['name']):
             try:
                 if process.info['name'].lower() == "voicevox.exe":
@@ -97,7 +233,7 @@ class CharacterVoicevox:
                 pass
         return False
 
-    # VOICEVOXが起動していなかったら起動する
+    # VOICEVOXが起動していなかったら起動する（起動したらTrueを返す）
     @staticmethod
     def run_voicevox(voicevox_path):
         appdata_local = os.getenv("LOCALAPPDATA")
@@ -105,87 +241,242 @@ class CharacterVoicevox:
         if os.path.isfile(voicevox_path):
             if not CharacterVoicevox.is_voicevox_running():
                 subprocess.Popen(voicevox_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                return True
+        return False
 
 # A.I.VOICEキャラクター
 class CharacterAIVoice:
-    DEFAULT_INSTALL_PATH = "%ProgramW6432%/AI/AIVoice/AIVoiceEditor/AI.Talk.Editor.Api.dll"
+    TTS_SOFTWARE = "AIVOICE"
+    # 起動を待つ最大時間（秒）
+    STARTUP_TIMEOUT = 10
 
     _tts_control = None
 
     def __init__(self, aivoice_path, speaker_id):
-        self.speaker_id = speaker_id
         self.aivoice_path = aivoice_path
-        CharacterAIVoice.run_aivoice(self.aivoice_path)
+        self._stop_event = threading.Event()
+        self.engine = CharacterAIVoice.get_engine(self.aivoice_path)
+        self.monitor = self.engine.monitor
+        self.update(speaker_id)
+
+    # 声を変更する（A.I.VOICEでは話す速さと声の高さはボイスプリセットで設定するので使わない）
+    def update(self, speaker_id, speed_scale=None, pitch_scale=None):
+        self.speaker_id = speaker_id
+        self._ready = self.engine.prepare(speaker_id)
 
     # 話す
     def talk(self, text):
-        CharacterAIVoice.run_aivoice(self.aivoice_path)
+        self.play(self.synthesize(text))
+
+    # 音声データを合成する
+    # A.I.VOICEは合成と再生を同時に行うため、ここではテキストをそのまま返す
+    def synthesize(self, text, stream=False):
+        self._ready.wait()
+        return text
+
+    # 準備ができるまで待つ（準備ができていればTrue）
+    def wait_until_ready(self, timeout=None) -> bool:
+        return self._ready.wait(timeout)
+
+    # テキストを読み上げる
+    def play(self, text):
+        if not self.monitor.is_up():
+            return
+
         try:
+            self._stop_event.clear()
             tts_control = CharacterAIVoice._tts_control
             tts_control.Connect()
             tts_control.CurrentVoicePresetName = self.speaker_id
             tts_control.Text = text
             play_time = tts_control.GetPlayTime()
             tts_control.Play()
-            time.sleep((play_time + 500) / 1000)
+            self._stop_event.wait((play_time + 500) / 1000)
         except Exception as err:
             CharacterAIVoice._tts_control = None
+            self.monitor.request_check()
             print(err)
             raise
 
-    # A.I.VOICEが起動していなかったら起動して接続する
+    # 読み上げを止める
+    def stop(self):
+        self._stop_event.set()
+        tts_control = CharacterAIVoice._tts_control
+        if tts_control is not None:
+            try:
+                tts_control.Stop()
+            except Exception:
+                pass
+
+    # A.I.VOICEのエンジンを取得する（キャラクターで共有する）
+    # 準備では起動と接続だけを待つ（合成すると声が出てしまうので、合成はしない）
+    @staticmethod
+    def get_engine(aivoice_path) -> SpeechEngine:
+        return SpeechEngine.get("AIVOICE", lambda: SpeechEngine(
+            CharacterAIVoice.start_monitor(aivoice_path),
+            CharacterAIVoice.STARTUP_TIMEOUT))
+
+    # A.I.VOICEの監視を開始する
+    @staticmethod
+    def start_monitor(aivoice_path) -> EngineMonitor:
+        return EngineMonitor.start(
+            "AIVOICE",
+            CharacterAIVoice.is_aivoice_running,
+            lambda: CharacterAIVoice.run_aivoice(aivoice_path))
+
+    # A.I.VOICEが起動していて接続済みかどうかを調べる
+    @staticmethod
+    def is_aivoice_running():
+        tts_control = CharacterAIVoice._tts_control
+        if tts_control is None:
+            return False
+
+        from AI.Talk.Editor.Api import HostStatus
+        return tts_control.Status != HostStatus.NotRunning
+
+    # A.I.VOICEが起動していなかったら起動して接続する（接続したらTrueを返す）
     @classmethod
     def run_aivoice(cls, aivoice_path):
         program_dir = os.getenv("ProgramW6432")
         aivoice_path = aivoice_path.replace("%ProgramW6432%", program_dir)
-        if os.path.isfile(aivoice_path):
-            if CharacterAIVoice._tts_control is None:
-                clr.AddReference(aivoice_path)
-                from AI.Talk.Editor.Api import TtsControl, HostStatus
-
-                tts_control = TtsControl()
-                host_name = tts_control.GetAvailableHostNames()[0]
-                tts_control.Initialize(host_name)        
-                if tts_control.Status == HostStatus.NotRunning:
-                    tts_control.StartHost()
-                tts_control.Connect()
-                cls._tts_control = tts_control
+        if not os.path.isfile(aivoice_path):
+            return False
+
+        tts_control = CharacterAIVoice._tts_control
+        if tts_control is None:
+            # pythonnetは起動を遅くするので、A.I.VOICEを使うときだけ読み込む
+            import clr
+
+            clr.AddReference(aivoice_path)
+            from AI.Talk.Editor.Api import TtsControl
+
+            tts_control = TtsControl()
+            host_name = tts_control.GetAvailableHostNames()[0]
+            tts_control.Initialize(host_name)
+
+        from AI.Talk.Editor.Api import HostStatus
+        if tts_control.Status == HostStatus.NotRunning:
+            tts_control.StartHost()
+        tts_control.Connect()
+        cls._tts_control = tts_control
+        return True
 
 # COEIROINKキャラクター
 class CharacterCoeiroink:
-    def __init__(self, coeiroink_path, speaker_id, speed_scale, pitch_scale):
+    TTS_SOFTWARE = "COEIROINK"
+    # 起動を待つ最大時間（秒）
+    STARTUP_TIMEOUT = 10
+
+    def __init__(self, coeiroink_path, speaker_id, speed_scale, pitch_scale, audio_cache: AudioCache = None):
         self.coeiroink_path = coeiroink_path
+        self.audio_cache = audio_cache
+        self.engine = CharacterCoeiroink.get_engine(self.coeiroink_path)
+        self.monitor = self.engine.monitor
+        self.update(speaker_id, speed_scale, pitch_scale)
+
+    # 声を変更する（エンジンとの接続はそのまま使う）
+    def update(self, speaker_id, speed_scale, pitch_scale):
+        self.speaker_id = speaker_id
         self.speed_scale = speed_scale
         self.pitch_scale = pitch_scale
-        self.speaker_id = speaker_id
-        CharacterCoeiroink.run_coeiroink(self.coeiroink_path)
+        self._ready = self.engine.prepare(speaker_id)
 
     # 話す
     def talk(self, text):
-        if CharacterCoeiroink.run_coeiroink(self.coeiroink_path):
-            wave_data = CoeiroinkApi.get_wave_data(
-                self.speaker_id, text, speedScale=self.speed_scale, pitchScale=self.pitch_scale, volumeScale=0.8)
+        self.play(self.synthesize(text, stream=True))
+
+    # 音声データを合成する
+    # streamがTrueなら、受信しながら再生できるようにWAVEデータのチャンクを返すイテレータを返す
+    def synthesize(self, text, stream=False):
+        self._ready.wait()
+        cache_key = self._get_cache_key(text)
+        if cache_key is not None:
+            wave_data = self.audio_cache.get(cache_key)
+            if wave_data is not None:
+                return wave_data
+
+        if not self.monitor.is_up():
+            return None
+
+        wave_data = CoeiroinkApi.get_wave_data(
+            self.speaker_id, text, speedScale=self.speed_scale, pitchScale=self.pitch_scale, volumeScale=0.8, stream=stream)
+        if wave_data is None:
+            self.monitor.request_check()
+        elif cache_key is not None:
+            if stream:
+                return self.audio_cache.put_stream(cache_key, wave_data)
+            self.audio_cache.put(cache_key, wave_data)
+        return wave_data
+
+    # 準備ができるまで待つ（準備ができていればTrue）
+    def wait_until_ready(self, timeout=None) -> bool:
+        return self._ready.wait(timeout)
+
+    # 合成音声キャッシュのキーを取得する（キャッシュを使わない場合はNone）
+    def _get_cache_key(self, text):
+        if self.audio_cache is None or not self.audio_cache.is_enabled():
+            return None
+        engine_version = self.engine.get_version()
+        if engine_version is None:
+            return None
+        return AudioCache.make_key(
+            "COEIROINK", self.speaker_id, self.speed_scale, self.pitch_scale, engine_version, text)
+
+    # 合成した音声データを再生する
+    def play(self, wave_data):
+        if wave_data is not None:
             play_sound(wave_data)
 
+    # 再生中の音声を止める
+    def stop(self):
+        stop_sound()
+
+    # COEIROINKのエンジンを取得する（キャラクターで共有する）
+    @staticmethod
+    def get_engine(coeiroink_path) -> SpeechEngine:
+        return SpeechEngine.get("COEIROINK", lambda: SpeechEngine(
+            CharacterCoeiroink.start_monitor(coeiroink_path),
+            CharacterCoeiroink.STARTUP_TIMEOUT,
+            CharacterCoeiroink.warm_up_speaker,
+            CoeiroinkApi.get_version))
+
+    # 話者の準備のために短い文を合成する
+    @staticmethod
+    def warm_up_speaker(speaker_id):
+        CoeiroinkApi.get_wave_data(speaker_id, WARM_UP_TEXT)
+
+    # COEIROINKの監視を開始する
+    @staticmethod
+    def start_monitor(coeiroink_path) -> EngineMonitor:
+        return EngineMonitor.start(
+            "COEIROINK",
+            CharacterCoeiroink.is_coeiroink_running,
+            lambda: CharacterCoeiroink.run_coeiroink(coeiroink_path))
+
     # COEIROINKが起動しているかどうかを調べる
     @staticmethod
     def is_coeiroink_running():
-        return CoeiroinkApi.get_status() is not None
+        return CoeiroinkApi.is_alive()
 
-    # COEIROINKが起動していなかったら起動する
+    # COEIROINKのプロセスがあるかどうかを調べる（立ち上がり中でAPIに応答しなくてもTrue）
+    # psutilは起動を遅くするので、使うときに読み込む
+    @staticmethod
+    def is_coeiroink_process_running(coeiroink_path):
+        import psutil
+
+        process_name = os.path.basename(coeiroink_path).lower()
+        for process in psutil.process_iter(['name']):
+            try:
+                if process.info['name'].lower() == process_name:
+                    return True
+            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                pass
+        return False
+
+    # COEIROINKのプロセスがなければ起動する（起動したらTrueを返す）
     @staticmethod
     def run_coeiroink(coeiroink_path):
-        if CharacterCoeiroink.is_coeiroink_running():
+        if os.path.isfile(coeiroink_path) and not CharacterCoeiroink.is_coeiroink_process_running(coeiroink_path):
+            subprocess.Popen(coeiroink_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
             return True
-        else:
-            if os.path.isfile(coeiroink_path):
-                subprocess.Popen(coeiroink_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                loop_count = 0
-                while CharacterCoeiroink.is_coeiroink_running() == False:
-                    time.sleep(1)
-                    loop_count += 1
-                    if loop_count >= 10:
-                        return False
-                return True
-            else:
-                return False
+        return False
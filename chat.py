@@ -6,77 +6,390 @@
 # このソースコードは MITライセンス の下でライセンスされています。
 # ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
 
-import json
 import os
+import threading
+import time
 from datetime import datetime
 from typing import Callable
 
-from openai import OpenAI
-from openai import AzureOpenAI
+import chat_log
+import metrics
+from chat_log import ChatLogWriter
+from log_index import LogIndex
+from sentence_segmenter import SentenceSegmenter
+from token_counter import TokenCounter
 
 # チャット基底クラス
 class Chat:
-    def __init__(self, client, model: str, instruction: str, bad_response: str, history_size: int, log_folder: str):
+    # ログを何メッセージごとにディスクへ確定させるか（0なら確定させない）
+    log_fsync_interval = 0
+    # ログに保存する要約のロール
+    SUMMARY_ROLE = "summary"
+    SUMMARY_PREFIX = "これまでの会話の要約:\n"
+    # 応答キャッシュのキーに含めるAPIの識別子
+    API_ID = ""
+
+    def __init__(self, client, model: str, instruction: str, bad_response: str, history_size: int, log_folder: str,
+                 segmenter: SentenceSegmenter = None, async_client = None, context_tokens: int = 0):
         self.messages = []
         self.client = client
+        self.async_client = async_client
         self.model = model
         self.instruction = instruction
         self.bad_response = bad_response
         self.history_size = history_size
+        self.context_tokens = context_tokens
+        self.token_counter = TokenCounter(model)
+        self.last_prompt_tokens = 0
+        self.last_full_prompt_tokens = 0
+        self.total_prompt_tokens = 0
+        self.total_full_prompt_tokens = 0
+        self._instruction_tokens = self.token_counter.count_message({"role": "system", "content": instruction})
+        self._token_counts = []
+        self._total_tokens = 0
         self.log_folder = log_folder
+        self.log_index = LogIndex(log_folder)
+        self.search_index = None
+        self.response_cache = None
+        self.segmenter = segmenter if segmenter is not None else SentenceSegmenter()
         self.chat_start_time = datetime.now()
+        self._logfile_name = None
+        self._log_writer = None
+        self._logged_count = 0
+        self.summarizer = None
+        self.summary = None
+        self._summary_end = 0
+        self._summary_tokens = 0
+        self._summary_thread = None
+        self._conversation_id = 0
+        self._response_start = None
+        self._first_token_time = None
+        self._lock = threading.RLock()
 
     # メッセージを送信して回答を得る
     def send_message(self, text: str, outputChunk: Callable[[str], None], outputSentence: Callable[[str], None]) -> str:
-        self.messages.append({"role": "user", "content": text})
-        messages = self.messages[-self.history_size:]
-        messages.insert(0, {"role": "system", "content": self.instruction})
-        stream = self.client.chat.completions.create(model=self.model, messages=messages, stream=True)
+        messages = self._prepare_messages(text)
+        cache_key, cached = self._lookup_response_cache(messages)
+        if cached is not None:
+            return self._replay_response(cached, outputChunk, outputSentence)
+
+        self._start_response_timer()
+        content_parts = []
+        role = ""
+        self.segmenter.reset()
+        stream = None
+        try:
+            stream = self.client.chat.completions.create(model=self.model, messages=messages, stream=True)
+            for chunk in stream:
+                role = self._process_chunk(chunk, role, content_parts, outputChunk, outputSentence)
+        except BaseException:
+            if stream is not None:
+                stream.response.close()
+            self._finish_response(role, content_parts, None)
+            raise
 
-        content = ""
-        sentence = ""
+        return self._finish_response(role, content_parts, outputSentence, cache_key)
+
+    # メッセージを送信して回答を得る（非同期版）
+    # 途中でキャンセルされたときは、受信を打ち切ってそこまでの回答を会話に残す
+    # 回答を受信する前にキャンセルされたときは、送ったメッセージを会話から取り除く
+    async def send_message_async(self, text: str, outputChunk: Callable[[str], None], outputSentence: Callable[[str], None]) -> str:
+        messages = self._prepare_messages(text)
+        cache_key, cached = self._lookup_response_cache(messages)
+        if cached is not None:
+            return self._replay_response(cached, outputChunk, outputSentence)
+
+        self._start_response_timer()
+        content_parts = []
         role = ""
-        for chunk in stream:
-            if chunk.choices[0].delta.role is not None:
-                role = chunk.choices[0].delta.role
+        self.segmenter.reset()
+        stream = None
+        try:
+            stream = await self.async_client.chat.completions.create(model=self.model, messages=messages, stream=True)
+            async for chunk in stream:
+                role = self._process_chunk(chunk, role, content_parts, outputChunk, outputSentence)
+        except BaseException:
+            if stream is not None:
+                await stream.response.aclose()
+            self._finish_response(role, content_parts, None)
+            raise
+
+        return self._finish_response(role, content_parts, outputSentence, cache_key)
+
+    # ユーザーのメッセージを会話に追加して、送信するメッセージを作成する
+    # context_tokensが設定されていればトークン数で、なければ会話数（history_size）で過去の会話を絞り込む
+    # 要約があれば、要約した範囲の会話の代わりに要約を送信する
+    def _prepare_messages(self, text: str):
+        self._append_message({"role": "user", "content": text})
+        with self._lock:
+            summary, summary_end, summary_tokens = self.summary, self._summary_end, self._summary_tokens
+
+        if self.context_tokens > 0:
+            start = self._get_context_start(summary_end, summary_tokens)
+        else:
+            start = max(len(self.messages) - self.history_size, summary_end)
+
+        messages = self.messages[start:]
+        if summary is not None:
+            messages.insert(0, self._summary_message(summary))
+        messages.insert(0, {"role": "system", "content": self.instruction})
+
+        self.last_prompt_tokens = self._instruction_tokens + summary_tokens + sum(self._token_counts[start:]) + TokenCounter.TOKENS_PER_REPLY
+        self.last_full_prompt_tokens = self._instruction_tokens + self._total_tokens + TokenCounter.TOKENS_PER_REPLY
+        self.total_prompt_tokens += self.last_prompt_tokens
+        self.total_full_prompt_tokens += self.last_full_prompt_tokens
+        return messages
+
+    # 応答キャッシュから送信するメッセージへの回答を探して、(キャッシュのキー, 回答) を返す
+    # キャッシュを使わない設定なら (None, None)、見つからなければ回答はNone
+    def _lookup_response_cache(self, messages):
+        if self.response_cache is None:
+            return (None, None)
+        key = self.response_cache.make_key(self.API_ID, self.model, messages)
+        return (key, self.response_cache.get(key))
+
+    # キャッシュした回答を、受信したときと同じように表示・読み上げして会話に追加する
+    def _replay_response(self, content, outputChunk, outputSentence):
+        self._response_start = None
+        self.segmenter.reset()
+        self._output_content(content, outputChunk, outputSentence)
+        return self._finish_response("assistant", [content], outputSentence)
 
-            if chunk.choices[0].delta.content is not None:
-                chunk_content = chunk.choices[0].delta.content
+    # トークン数の上限に収まる範囲で、送信する最初のメッセージの位置を取得する（lowerより前には戻らない）
+    # システムメッセージと最新のメッセージは、上限を超えても必ず送信する
+    def _get_context_start(self, lower: int = 0, reserved_tokens: int = 0):
+        budget = self.context_tokens - self._instruction_tokens - reserved_tokens - TokenCounter.TOKENS_PER_REPLY
+        if lower == 0 and self._total_tokens <= budget:
+            return 0
+
+        start = len(self.messages) - 1
+        total = self._token_counts[start]
+        while start > lower and total + self._token_counts[start - 1] <= budget:
+            start -= 1
+            total += self._token_counts[start]
+        return start
+
+    # 要約を送信するメッセージにする
+    def _summary_message(self, summary: str):
+        return {"role": "system", "content": Chat.SUMMARY_PREFIX + summary}
+
+    # 要約されていない古い会話が多くなったら、バックグラウンドで要約を作りはじめる
+    # 最新のメッセージはそのまま送信するので、要約には含めない
+    def _start_summary_if_needed(self):
+        if self.summarizer is None:
+            return
+
+        with self._lock:
+            if self._summary_thread is not None:
+                return
+            end = len(self.messages) - self.summarizer.KEEP_MESSAGES
+            if end <= self._summary_end or sum(self._token_counts[self._summary_end:end]) < self.summarizer.threshold:
+                return
+
+            args = (self._conversation_id, self.summary, self.messages[self._summary_end:end], end)
+            self._summary_thread = threading.Thread(target=self._summary_worker, args=args, daemon=True)
+            self._summary_thread.start()
+
+    # 要約スレッド（要約ができたら、ログにも保存して次のターンから使う）
+    def _summary_worker(self, conversation_id, summary, messages, end):
+        try:
+            summary = self.summarizer.summarize(summary, messages)
+        except Exception:
+            summary = None
+
+        with self._lock:
+            self._summary_thread = None
+            if not summary or conversation_id != self._conversation_id:
+                return
+            self.summary = summary
+            self._summary_end = end
+            self._summary_tokens = self.token_counter.count_message(self._summary_message(summary))
+            try:
+                self._write_summary_log()
+            except OSError:
+                pass
+
+    # 要約をログに保存する
+    def _write_summary_log(self):
+        writer = self._get_log_writer()
+        if writer is not None:
+            writer.append([self._summary_record()])
+
+    # ログに保存する要約のレコードを作成する（endは要約に含めたメッセージの数）
+    def _summary_record(self):
+        return {"role": Chat.SUMMARY_ROLE, "content": self.summary, "end": self._summary_end}
+
+    # 会話にメッセージを追加する（トークン数はここで一度だけ数えておく）
+    def _append_message(self, message):
+        count = self.token_counter.count_message(message)
+        self.messages.append(message)
+        self._token_counts.append(count)
+        self._total_tokens += count
+
+    # ログに保存していない最後のユーザーのメッセージを会話から取り除く
+    def _discard_pending_message(self):
+        with self._lock:
+            if len(self.messages) > self._logged_count and self.messages[-1]["role"] == "user":
+                self.messages.pop()
+                self._total_tokens -= self._token_counts.pop()
+
+    # 会話全体を置き換える（ログに保存された要約のレコードは要約として取り出す）
+    def _set_messages(self, messages):
+        with self._lock:
+            self._conversation_id += 1
+            self.messages = []
+            self._token_counts = []
+            self._total_tokens = 0
+            self.summary = None
+            self._summary_end = 0
+            self._summary_tokens = 0
+            for message in messages:
+                if message.get("role") == Chat.SUMMARY_ROLE:
+                    self.summary = message["content"]
+                    self._summary_end = message.get("end", 0)
+                else:
+                    self._append_message(message)
 
-                content += chunk_content
-                sentence += chunk_content
-                outputChunk(chunk_content)
+            if self.summary is not None:
+                self._summary_end = min(self._summary_end, len(self.messages))
+                self._summary_tokens = self.token_counter.count_message(self._summary_message(self.summary))
 
-                if sentence.endswith(("。", "\n", "？", "！")):
-                    outputSentence(sentence)
-                    sentence = ""
+    # 受信したチャンクを処理して、ロールを返す
+    def _process_chunk(self, chunk, role, content_parts, outputChunk, outputSentence):
+        if chunk.choices[0].delta.role is not None:
+            role = chunk.choices[0].delta.role
 
-        if sentence != "":
+        if chunk.choices[0].delta.content is not None:
+            chunk_content = chunk.choices[0].delta.content
+            if self._response_start is not None and self._first_token_time is None:
+                self._first_token_time = time.perf_counter()
+                metrics.record("chat.first_token", (self._first_token_time - self._response_start) * 1000)
+            content_parts.append(chunk_content)
+            self._output_content(chunk_content, outputChunk, outputSentence)
+
+        return role
+
+    # 回答の文字列を表示して、区切れた文を読み上げる
+    def _output_content(self, content, outputChunk, outputSentence):
+        for piece, sentence in self.segmenter.feed(content):
+            if piece != "":
+                outputChunk(piece)
+            if sentence is not None:
+                outputSentence(sentence)
+
+    # 受信を終えた回答を会話に追加する（outputSentenceがNoneなら残りの文は読み上げない）
+    # cache_keyが指定されていれば、回答を応答キャッシュに保存する
+    # 回答がなければ、次の送信でユーザーのメッセージが2つ並ばないように、送ったメッセージを会話から取り除く
+    def _finish_response(self, role, content_parts, outputSentence, cache_key = None):
+        sentence = self.segmenter.flush()
+        if sentence is not None and outputSentence is not None:
             outputSentence(sentence)
 
+        content = "".join(content_parts)
+        if content and outputSentence is not None:
+            self._record_response_metrics(content)
         if content:
-            self.messages.append({"role": role, "content": content})
+            self._append_message({"role": role or "assistant", "content": content})
+            if cache_key is not None:
+                self.response_cache.put(cache_key, content)
             self.write_chat_log()
+            self._start_summary_if_needed()
             return content
         else:
+            self._discard_pending_message()
             return self.bad_response
     
-    # チャットのログを保存する
+    # 回答の受信を始める時刻を記録する
+    def _start_response_timer(self):
+        self._response_start = time.perf_counter()
+        self._first_token_time = None
+
+    # 回答の受信にかかった時間と、受信の速さ（1秒あたりのトークン数）を記録する
+    def _record_response_metrics(self, content):
+        if self._response_start is None:
+            return
+        end = time.perf_counter()
+        metrics.record("chat.response", (end - self._response_start) * 1000)
+        if self._first_token_time is not None and end > self._first_token_time:
+            metrics.record("chat.tokens_per_sec", self.token_counter.count_text(content) / (end - self._first_token_time))
+        self._response_start = None
+
+    # チャットのログを保存する（書き込みと検索索引の更新はログ書き込みスレッドで行う）
     def write_chat_log(self):
+        with self._lock:
+            writer = self._get_log_writer()
+            if writer is None:
+                return
+            writer.append(self.messages[self._logged_count:])
+            self._logged_count = len(self.messages)
+
+        if self.search_index is not None:
+            filename = self.get_logfile_name()
+            chat_log.submit(lambda: self.search_index.index_file(filename))
+
+    # 追記用のログファイルを取得する（ログを保存しない設定ならNone）
+    def _get_log_writer(self):
         if self.log_folder == "":
-            return
+            return None
 
         if not os.path.exists(self.log_folder):
             os.mkdir(self.log_folder)
 
+        if self._log_writer is None:
+            self._open_log_writer()
+        return self._log_writer
+
+    # ログファイルを追記用に開く
+    # 以前のバージョンのログファイルや書庫にしまわれたログを読み込んでいたら、
+    # 読み込んだ会話を新しい形式のログファイルに書き出してから追記する
+    # ファイルは書き込みスレッドで作成されるので、ログの索引への追加も作成したあとに書き込みスレッドで行う
+    # （作成より先に追加すると、フォルダの更新日時が変わって次に使うときに索引を作りなおしてしまう）
+    def _open_log_writer(self):
         filename = self.get_logfile_name()
-        path = os.path.join(self.log_folder, filename)
-        with open(path, "w", encoding="utf-8") as file:
-            json.dump(self.messages, file, ensure_ascii=False, indent=4)
+        legacy = chat_log.is_legacy_log(filename)
+        archived = self.log_index.get_archive(filename) is not None
+        if not legacy and not archived:
+            path = os.path.join(self.log_folder, filename)
+            self._log_writer = ChatLogWriter(path, Chat.log_fsync_interval, lambda: self.log_index.add(filename))
+            return
+
+        if legacy:
+            self._logfile_name = filename[:-len(chat_log.LEGACY_LOG_EXTENSION)] + chat_log.LOG_EXTENSION
+        logfile_name = self._logfile_name
+        path = os.path.join(self.log_folder, logfile_name)
+        self._log_writer = ChatLogWriter(path, Chat.log_fsync_interval, lambda: self.log_index.add(logfile_name))
+        messages = self.messages[:self._logged_count]
+        if self.summary is not None:
+            messages.append(self._summary_record())
+        self._log_writer.rewrite(messages)
+
+        if legacy and not archived:
+            chat_log.submit(lambda: self._remove_legacy_log(filename))
+
+    # 新しい形式に書き出した、以前のバージョンのログファイルを削除する
+    def _remove_legacy_log(self, filename):
+        os.remove(os.path.join(self.log_folder, filename))
+        self.log_index.remove(filename)
+        if self.search_index is not None:
+            self.search_index.remove_file(filename)
+
+    # ログファイルを閉じる（ログの書き込みが終わるまで待つ）
+    def _close_log_writer(self):
+        with self._lock:
+            if self._log_writer is not None:
+                self._log_writer.close()
+                self._log_writer = None
+        chat_log.flush()
+
+    # チャットを終了する（ログの書き込みが終わるまで待つ）
+    def close(self):
+        self._close_log_writer()
 
     # ログファイルの名前を取得する
     def get_logfile_name(self):
-        return self.chat_start_time.strftime("chatlog-%Y%m%d-%H%M%S.txt")
+        if self._logfile_name is not None:
+            return self._logfile_name
+        return self.chat_start_time.strftime("chatlog-%Y%m%d-%H%M%S") + chat_log.LOG_EXTENSION
     
     # ログファイルの名前に記載された日時を取得する
     def _filename_to_datetime(self, logfile_name):
@@ -90,70 +403,68 @@ class Chat:
 
     # ひとつ前の会話内容を読み込む
     def load_prev(self):
-        filename = self.get_logfile_name()
-        index = self._search_logfile(filename)
-        if index != -1:
-            index += 1
-        else:
-            index = 0
-
-        files = os.listdir(self.log_folder)
-        files.sort(reverse=True)
-        if index < len(files):
-            self._load(files[index])
+        filename = self.log_index.get_prev(self.get_logfile_name())
+        if filename is not None:
+            self._load(filename)
 
     # ひとつ後の会話内容を読み込む
     def load_next(self):
-        filename = self.get_logfile_name()
-        index = self._search_logfile(filename)
-        if index != -1:
-            index -= 1
-        
-        if index >= 0:
-            files = os.listdir(self.log_folder)
-            files.sort(reverse=True)
-            if index < len(files):
-                self._load(files[index])
+        filename = self.log_index.get_next(self.get_logfile_name())
+        if filename is not None:
+            self._load(filename)
         else:
-            self.messages = []
+            self._close_log_writer()
+            self._set_messages([])
             self.chat_start_time = datetime.now()
+            self._logfile_name = None
+            self._logged_count = 0
+
+    # 指定したログファイルの会話を読み込む
+    def load_log(self, logfile_name):
+        self._load(logfile_name)
 
     # ログファイルから会話を読み込む
     def _load(self, logfile_name):
-        path = os.path.join(self.log_folder, logfile_name)
-        with open(path, "r", encoding="utf-8") as file:
-            self.messages = json.load(file)
-            self.chat_start_time = self._filename_to_datetime(logfile_name)
+        self._close_log_writer()
+        self._set_messages(self.log_index.read_messages(logfile_name))
+        self.chat_start_time = self._filename_to_datetime(logfile_name)
+        self._logfile_name = logfile_name
+        self._logged_count = len(self.messages)
     
-    # 指定されたログファイルのインデックスを取得する
-    def _search_logfile(self, logfile_name):
-        files = os.listdir(self.log_folder)
-        files.sort(reverse=True)
-        for index, file in enumerate(files):
-            if file == logfile_name:
-                return index
-        return -1
-        
 # OpenAI チャットクラス
 class ChatOpenAI(Chat):
-    def __init__(self, model: str, instruction: str, bad_response: str, history_size: int, log_folder: str):
+    API_ID = "OpenAI"
+
+    def __init__(self, model: str, instruction: str, bad_response: str, history_size: int, log_folder: str,
+                 segmenter: SentenceSegmenter = None, context_tokens: int = 0):
         api_key = os.environ.get("OPENAI_API_KEY")
         if api_key is None:
             raise ValueError("環境変数 OPENAI_API_KEY が設定されていません。")
 
+        # openaiは起動を遅くするので、チャットを作るときに読み込む
+        from openai import OpenAI
+        from openai import AsyncOpenAI
+
         client = OpenAI()
+        async_client = AsyncOpenAI()
         super().__init__(
             client = client,
             model = model,
             instruction = instruction,
             bad_response = bad_response,
             history_size = history_size,
-            log_folder = log_folder
+            log_folder = log_folder,
+            segmenter = segmenter,
+            async_client = async_client,
+            context_tokens = context_tokens
         )
 
 # Azure OpenAI チャットクラス
 class ChatAzureOpenAI(Chat):
-    def __init__(self, model: str, instruction: str, bad_response: str, history_size: int, log_folder: str):
+    API_ID = "AzureOpenAI"
+
+    def __init__(self, model: str, instruction: str, bad_response: str, history_size: int, log_folder: str,
+                 segmenter: SentenceSegmenter = None, context_tokens: int = 0):
         endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT")
         if endpoint is None:
             raise ValueError("環境変数 AZURE_OPENAI_ENDPOINT が設定されていません。")
@@ -162,24 +473,33 @@ class ChatAzureOpenAI(Chat):
         if api_key is None:
             raise ValueError("環境変数 AZURE_OPENAI_API_KEY が設定されていません。")
 
+        # openaiは起動を遅くするので、チャットを作るときに読み込む
+        from openai import AzureOpenAI
+        from openai import AsyncAzureOpenAI
+
         client = AzureOpenAI(azure_endpoint=endpoint, api_key=api_key, api_version="2023-05-15")
+        async_client = AsyncAzureOpenAI(azure_endpoint=endpoint, api_key=api_key, api_version="2023-05-15")
         super().__init__(
             client = client,
             model = model,
             instruction = instruction,
             bad_response = bad_response,
             history_size = history_size,
-            log_folder = log_folder
+            log_folder = log_folder,
+            segmenter = segmenter,
+            async_client = async_client,
+            context_tokens = context_tokens
         )
 
 # チャットファクトリー
 class ChatFactory:
     # api_idに基づいてChatオブジェクトを作成する
     @staticmethod
-    def create(api_id: str, model: str, instruction: str, bad_response: str, history_size: int, log_folder: str) -> Chat:
+    def create(api_id: str, model: str, instruction: str, bad_response: str, history_size: int, log_folder: str,
+               segmenter: SentenceSegmenter = None, context_tokens: int = 0) -> Chat:
         if api_id == "OpenAI":
-            return ChatOpenAI(model, instruction, bad_response, history_size, log_folder)
+            return ChatOpenAI(model, instruction, bad_response, history_size, log_folder, segmenter, context_tokens)
         elif api_id == "AzureOpenAI":
-            return ChatAzureOpenAI(model, instruction, bad_response, history_size, log_folder)
+            return ChatAzureOpenAI(model, instruction, bad_response, history_size, log_folder, segmenter, context_tokens)
         else:
             raise ValueError("API IDが間違っています。")
@@ -0,0 +1,232 @@
+# ZundaGPT
+#
+# チャットログモジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+from typing import Callable, Iterator, TextIO
+
+# ログファイルの拡張子
+LOG_EXTENSION = ".jsonl"
+# 以前のバージョンのログファイル（JSON配列をまとめて書き込んだもの）の拡張子
+LEGACY_LOG_EXTENSION = ".txt"
+
+# 以前のバージョンのログファイルかどうか
+def is_legacy_log(path: str) -> bool:
+    return path.endswith(LEGACY_LOG_EXTENSION)
+
+# ログファイルからメッセージを順番に読み込む
+def read_messages(path: str) -> Iterator[dict]:
+    with open(path, "r", encoding="utf-8") as file:
+        yield from parse_messages(file)
+
+# 開いたログからメッセージを順番に読み込む
+# 1行1メッセージのJSONL形式と、以前のバージョンのJSON配列形式のどちらも読み込める
+# 書き込み途中で終了したなどで壊れている行は読み飛ばす
+def parse_messages(file: TextIO) -> Iterator[dict]:
+    first_line = file.readline()
+    if first_line.lstrip().startswith("["):
+        yield from json.loads(first_line + file.read())
+        return
+
+    line = first_line
+    while line:
+        line = line.strip()
+        if line:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                pass
+        line = file.readline()
+
+# ログ書き込みスレッドクラス
+# ログファイルへの書き込みをバックグラウンドのスレッドで順番に行い、会話のターンを待たせないようにする
+class LogWriterThread:
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # 書き込み処理を登録する（登録した順番に実行する）
+    def submit(self, task: Callable[[], None]):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._queue.put(task)
+
+    # 登録済みの書き込み処理がすべて終わるまで待つ
+    def flush(self):
+        if threading.current_thread() is self._thread:
+            return
+        self._queue.join()
+
+    # スレッド処理
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                task()
+            except Exception as err:
+                print(f"ログの書き込みに失敗しました: {err}", file=sys.stderr)
+            finally:
+                self._queue.task_done()
+
+# すべてのログの書き込みを行うスレッド
+_writer_thread = LogWriterThread()
+# 終了するときは、登録済みの書き込みが終わるまで待つ
+atexit.register(_writer_thread.flush)
+
+# ログの書き込みスレッドで処理を行う（それまでに登録した書き込みが終わってから実行される）
+def submit(task: Callable[[], None]):
+    _writer_thread.submit(task)
+
+# 登録済みのログの書き込みがすべて終わるまで待つ
+def flush():
+    _writer_thread.flush()
+
+# チャットログ書き込みクラス
+# メッセージを1行ずつ追記するので、会話が長くなっても書き込む量は増えない
+# 書き込みはログ書き込みスレッドで行い、続けて追記されたメッセージは1回の書き込みにまとめる
+class ChatLogWriter:
+    def __init__(self, path: str, fsync_interval: int = 0, on_file_created: Callable[[], None] = None):
+        # fsync_intervalは何メッセージごとにディスクへの書き込みを確定させるか（0なら確定させない）
+        # on_file_createdはファイルを作成した（置き換えた）あとに、書き込みスレッドで呼び出す関数
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.on_file_created = on_file_created
+        self._unsynced = 0
+        self._file = None
+        self._closed = False
+        self._pending = []
+        self._pending_count = 0
+        self._rewrite = None
+        self._scheduled = False
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    # メッセージを追記する
+    def append(self, messages):
+        if len(messages) == 0:
+            return
+
+        lines = "".join(json.dumps(message, ensure_ascii=False) + "\n" for message in messages)
+        with self._lock:
+            self._pending.append(lines)
+            self._pending_count += len(messages)
+            self._schedule()
+
+    # ファイルの内容をメッセージで置き換える
+    # 書き込み中に止まっても元のファイルが壊れないように、一時ファイルに書いてから置き換える
+    def rewrite(self, messages):
+        lines = "".join(json.dumps(message, ensure_ascii=False) + "\n" for message in messages)
+        with self._lock:
+            self._rewrite = lines
+            self._pending = []
+            self._pending_count = 0
+            self._schedule()
+
+    # ファイルを閉じる（書き込みが終わるまで待つ）
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        atexit.unregister(self.close)
+        _writer_thread.submit(self._close_file)
+        _writer_thread.flush()
+
+    # 書き込みスレッドに書き込みを登録する（登録済みでまだ書き込んでいなければ、その書き込みにまとめる）
+    def _schedule(self):
+        if not self._scheduled:
+            self._scheduled = True
+            _writer_thread.submit(self._write_pending)
+
+    # 書き込みスレッドで、たまっている内容を書き込む
+    def _write_pending(self):
+        with self._lock:
+            rewrite, data, count = self._rewrite, "".join(self._pending), self._pending_count
+            self._rewrite = None
+            self._pending = []
+            self._pending_count = 0
+            self._scheduled = False
+
+        if rewrite is not None:
+            self._replace_file(rewrite)
+        if data == "":
+            return
+
+        if self._file is None:
+            self._open_file()
+        self._file.write(data)
+        self._file.flush()
+
+        self._unsynced += count
+        if self.fsync_interval > 0 and self._unsynced >= self.fsync_interval:
+            self._sync()
+
+    # 一時ファイルに書き込んでから、ログファイルと置き換える
+    def _replace_file(self, data):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        # 一時ファイルの名前はログの索引に入らないように、ログファイルの名前で始めない
+        folder, name = os.path.split(self.path)
+        temp_path = os.path.join(folder, "tmp-" + name)
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+        self._unsynced = 0
+        self._notify_file_created()
+
+    # ファイルを追記用に開く
+    def _open_file(self):
+        created = not os.path.exists(self.path)
+        self._file = open(self.path, "a+", encoding="utf-8")
+        self._terminate_torn_line()
+        if created:
+            self._notify_file_created()
+
+    # ファイルを作成したことを知らせる
+    def _notify_file_created(self):
+        if self.on_file_created is not None:
+            self.on_file_created()
+
+    # 書き込みスレッドでファイルを閉じる
+    def _close_file(self):
+        if self._file is None:
+            return
+        try:
+            self._file.flush()
+            if self.fsync_interval > 0 and self._unsynced > 0:
+                self._sync()
+        finally:
+            self._file.close()
+            self._file = None
+
+    # ディスクへの書き込みを確定させる
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    # 前回書き込み途中で終了していたら、続きが同じ行にならないように改行しておく
+    def _terminate_torn_line(self):
+        size = self._file.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        with open(self.path, "rb") as file:
+            file.seek(size - 1)
+            if file.read(1) != b"\n":
+                self._file.write("\n")
+                self._file.flush()
@@ -0,0 +1,39 @@
+# ZundaGPT
+#
+# 会話要約モジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+# 会話要約クラス
+# 古い会話を短い要約にまとめて、チャットに送信するメッセージを小さくする
+class ChatSummarizer:
+    # 要約せずにそのまま送信する最新のメッセージの数
+    KEEP_MESSAGES = 4
+    INSTRUCTION = (
+        "あなたは会話の要約係です。これまでの要約と新しい会話をまとめて、ひとつの要約を作ってください。"
+        "今後の会話に必要な事実、ユーザーの好みや依頼、話題の流れを箇条書きで簡潔に書き、要約以外のことは書かないでください。")
+
+    def __init__(self, client, model: str, threshold: int, max_tokens: int):
+        # thresholdは要約されていない古い会話が何トークンを超えたら要約するか
+        self.client = client
+        self.model = model
+        self.threshold = threshold
+        self.max_tokens = max_tokens
+
+    # これまでの要約と新しいメッセージをまとめた要約を作る
+    def summarize(self, summary: str, messages) -> str:
+        parts = []
+        if summary:
+            parts.append(f"# これまでの要約\n{summary}")
+        conversation = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        parts.append(f"# 新しい会話\n{conversation}")
+
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": ChatSummarizer.INSTRUCTION},
+                {"role": "user", "content": "\n\n".join(parts)}],
+            max_tokens=self.max_tokens)
+        return response.choices[0].message.content.strip()
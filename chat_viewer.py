@@ -0,0 +1,96 @@
+# ZundaGPT
+#
+# チャット表示モジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+import os
+import sys
+from typing import Callable
+
+_vt_mode_enabled = False
+
+# 画面をクリアする
+# 外部コマンド（cls/clear）を起動せずに、エスケープシーケンスでクリアする
+def clear_screen():
+    _enable_vt_mode()
+    sys.stdout.write("\033[2J\033[3J\033[H")
+    sys.stdout.flush()
+
+# Windowsのコンソールでエスケープシーケンスを使えるようにする
+def _enable_vt_mode():
+    global _vt_mode_enabled
+    if _vt_mode_enabled:
+        return
+    _vt_mode_enabled = True
+
+    if os.name != "nt":
+        return
+
+    import ctypes
+    from ctypes import wintypes
+
+    ENABLE_VIRTUAL_TERMINAL_PROCESSING = 0x0004
+    kernel32 = ctypes.windll.kernel32
+    handle = kernel32.GetStdHandle(-11)
+    mode = wintypes.DWORD()
+    if kernel32.GetConsoleMode(handle, ctypes.byref(mode)):
+        kernel32.SetConsoleMode(handle, mode.value | ENABLE_VIRTUAL_TERMINAL_PROCESSING)
+
+# チャット表示クラス
+# 読み込んだ会話を全部表示せずに、最新のページだけを表示する
+# 古いページは必要になったときに1ページずつ表示する
+class ChatViewer:
+    def __init__(self, page_size: int, print_header: Callable[[], None], print_message: Callable[[dict], None]):
+        # page_sizeは1ページに表示するメッセージの数（1より小さければ1にする）
+        self.page_size = max(page_size, 1)
+        self.print_header = print_header
+        self.print_message = print_message
+        # 表示中のページの終わりの位置（Noneなら会話の最後。会話が続いても最新のページを指す）
+        self._end = None
+
+    # 最新のページを表示する（会話を読み込みなおしたときも、これで表示位置を最新に戻す）
+    def show_latest(self, messages):
+        self._end = None
+        self._show(messages)
+
+    # ひとつ古いページを表示する（もう古いページがなければFalse）
+    def show_older(self, messages) -> bool:
+        end = self._get_end(messages) - self.page_size
+        if end <= 0:
+            return False
+        self._end = end
+        self._show(messages)
+        return True
+
+    # ひとつ新しいページを表示する（もう新しいページがなければFalse）
+    def show_newer(self, messages) -> bool:
+        end = self._get_end(messages)
+        if end >= len(messages):
+            return False
+        self._end = end + self.page_size
+        if self._end >= len(messages):
+            self._end = None
+        self._show(messages)
+        return True
+
+    # 表示中のページの終わりの位置を取得する
+    def _get_end(self, messages) -> int:
+        return len(messages) if self._end is None else min(self._end, len(messages))
+
+    # 表示中のページを表示する
+    def _show(self, messages):
+        end = self._get_end(messages)
+        start = max(end - self.page_size, 0)
+        clear_screen()
+        self.print_header()
+        if start > 0:
+            print(f"（これより前に {start} 件のメッセージがあるのだ。@older で表示するのだ）")
+            print()
+        for message in messages[start:end]:
+            self.print_message(message)
+        if end < len(messages):
+            print(f"（これより後に {len(messages) - end} 件のメッセージがあるのだ。@newer で表示するのだ）")
+            print()
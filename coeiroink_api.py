@@ -7,18 +7,54 @@
 # ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
 
 import json
+import threading
 
-import requests
+import http_session
+import metrics
 
 class CoeiroinkApi:
     DEFAULT_SERVER = "http://127.0.0.1:50032"
     server = DEFAULT_SERVER
+    session = http_session.create_session()
+    timeout = (http_session.DEFAULT_CONNECT_TIMEOUT, http_session.DEFAULT_READ_TIMEOUT)
+
+    # ストリーミング受信するときのチャンクサイズ
+    STREAM_CHUNK_SIZE = 8192
+
+    _cache_lock = threading.Lock()
+    _speaker_info_cache = {}
+    _alive_states = {}
+
+    # エンジンが起動しているかどうかを取得する（確認した結果は再起動の検出に使う）
+    @staticmethod
+    def is_alive() -> bool:
+        server = CoeiroinkApi.server
+        alive = CoeiroinkApi.get_status() is not None
+        CoeiroinkApi._set_alive(server, alive)
+        return alive
+
+    # 記録した起動状態を破棄する（次に起動を確認したときに、話者情報も取得しなおす）
+    @staticmethod
+    def invalidate_status():
+        with CoeiroinkApi._cache_lock:
+            CoeiroinkApi._alive_states.pop(CoeiroinkApi.server, None)
+
+    # 起動状態を記録する
+    # 停止していたエンジンが起動した（再起動した）ときは、話者情報のキャッシュを破棄する
+    @staticmethod
+    def _set_alive(server, alive):
+        with CoeiroinkApi._cache_lock:
+            cached = CoeiroinkApi._alive_states.get(server)
+            if alive and not cached:
+                CoeiroinkApi._speaker_info_cache = {
+                    key: value for key, value in CoeiroinkApi._speaker_info_cache.items() if key[0] != server}
+            CoeiroinkApi._alive_states[server] = alive
 
     # ステータスを取得する
     @staticmethod
     def get_status(print_error=False) -> str:
         try:
-            response = requests.get(f"{CoeiroinkApi.server}/")
+            response = CoeiroinkApi.session.get(f"{CoeiroinkApi.server}/", timeout=CoeiroinkApi.timeout)
             response.raise_for_status()
             return response.json()["status"]
         except Exception as err:
@@ -26,11 +62,23 @@ class CoeiroinkApi:
                 print(err)
             return None
 
+    # エンジンのバージョンを取得する
+    @staticmethod
+    def get_version(print_error=False) -> str:
+        try:
+            response = CoeiroinkApi.session.get(f"{CoeiroinkApi.server}/v1/engine_info", timeout=CoeiroinkApi.timeout)
+            response.raise_for_status()
+            return response.json()["version"]
+        except Exception as err:
+            if print_error:
+                print(err)
+            return None
+
     # 話者リストを取得する
     @staticmethod
     def get_speakers(print_error=False) -> {}:
         try:
-            response = requests.get(f"{CoeiroinkApi.server}/v1/speakers")
+            response = CoeiroinkApi.session.get(f"{CoeiroinkApi.server}/v1/speakers", timeout=CoeiroinkApi.timeout)
             response.raise_for_status()
             return response.json()
         except Exception as err:
@@ -43,7 +91,7 @@ class CoeiroinkApi:
     def get_speaker_info(styleId: int, print_error=False) -> {}:
         try:
             post_params = {"styleId": styleId}
-            response = requests.post(f"{CoeiroinkApi.server}/v1/style_id_to_speaker_meta", params=post_params)
+            response = CoeiroinkApi.session.post(f"{CoeiroinkApi.server}/v1/style_id_to_speaker_meta", params=post_params, timeout=CoeiroinkApi.timeout)
             response.raise_for_status()
             return response.json()
         except Exception as err:
@@ -51,12 +99,28 @@ class CoeiroinkApi:
                 print(err)
             return None
 
+    # スタイルIDから話者情報を取得する（取得した情報はエンジンが再起動するまで使い回す）
+    @staticmethod
+    def get_speaker_info_cached(styleId: int, print_error=False) -> {}:
+        key = (CoeiroinkApi.server, str(styleId))
+        with CoeiroinkApi._cache_lock:
+            speaker = CoeiroinkApi._speaker_info_cache.get(key)
+        if speaker is not None:
+            return speaker
+
+        speaker = CoeiroinkApi.get_speaker_info(styleId, print_error)
+        if speaker is not None:
+            with CoeiroinkApi._cache_lock:
+                CoeiroinkApi._speaker_info_cache[key] = speaker
+        return speaker
+
     # テキストの読み上げ用データを取得する
     @staticmethod
     def estimate_prosody(text: str, print_error=False) -> {}:
         try:
             post_params = {"text": text}
-            response = requests.post(f"{CoeiroinkApi.server}/v1/estimate_prosody", data=json.dumps(post_params))
+            with metrics.timer("coeiroink.estimate_prosody"):
+                response = CoeiroinkApi.session.post(f"{CoeiroinkApi.server}/v1/estimate_prosody", data=json.dumps(post_params), timeout=CoeiroinkApi.timeout)
             response.raise_for_status()
             return response.json()
         except Exception as err:
@@ -65,10 +129,11 @@ class CoeiroinkApi:
             return None
 
     # 音声データを生成する
+    # streamがTrueなら、受信したWAVEデータのチャンクを順に返すイテレータを返す（計測する時間は受信を始めるまで）
     @staticmethod
     def synthesis(speaker: {}, text: str, prosody: {},
                   speedScale = 1, volumeScale = 1, pitchScale = 0, intonationScale = 1,
-                  prePhonemeLength = 0.1, postPhonemeLength = 0.1, outputSamplingRate = 24000, print_error=False) -> bytes:
+                  prePhonemeLength = 0.1, postPhonemeLength = 0.1, outputSamplingRate = 24000, print_error=False, stream=False) -> bytes:
         post_params = {
             "speakerUuid": speaker["speakerUuid"],
             "styleId": speaker["styleId"],
@@ -83,28 +148,48 @@ class CoeiroinkApi:
             "outputSamplingRate": outputSamplingRate
         }
         try:
-            response = requests.post(f"{CoeiroinkApi.server}/v1/synthesis", data=json.dumps(post_params))
-            response.raise_for_status()
-            return response.content
+            with metrics.timer("coeiroink.synthesis"):
+                response = CoeiroinkApi.session.post(f"{CoeiroinkApi.server}/v1/synthesis", data=json.dumps(post_params), timeout=CoeiroinkApi.timeout, stream=stream)
+            if not stream:
+                response.raise_for_status()
+                return response.content
+
+            try:
+                response.raise_for_status()
+            except Exception:
+                response.close()
+                raise
+            return CoeiroinkApi._iter_content(response)
         except Exception as err:
             if print_error:
                 print(err)
             return None
 
+    # レスポンスのデータをチャンクごとに返す
+    @staticmethod
+    def _iter_content(response):
+        with response:
+            yield from response.iter_content(chunk_size=CoeiroinkApi.STREAM_CHUNK_SIZE)
+
     # 音声データを生成する
     @staticmethod
     def get_wave_data(styleId: int, text: str,
                       speedScale = 1, volumeScale = 1, pitchScale = 0, intonationScale = 1,
-                      prePhonemeLength = 0.1, postPhonemeLength = 0.1, outputSamplingRate = 24000, print_error=False) -> bytes:
+                      prePhonemeLength = 0.1, postPhonemeLength = 0.1, outputSamplingRate = 24000, print_error=False, stream=False) -> bytes:
 
-        speaker = CoeiroinkApi.get_speaker_info(styleId)
+        speaker = CoeiroinkApi.get_speaker_info_cached(styleId)
         if speaker is None:
+            CoeiroinkApi.invalidate_status()
             return None
         
         prosody = CoeiroinkApi.estimate_prosody(text)
         if prosody is None:
+            CoeiroinkApi.invalidate_status()
             return None
         
-        return CoeiroinkApi.synthesis(speaker, text, prosody,
-                                      speedScale, volumeScale, pitchScale, intonationScale,
-                                      prePhonemeLength, postPhonemeLength, outputSamplingRate, print_error)
+        wave_data = CoeiroinkApi.synthesis(speaker, text, prosody,
+                                           speedScale, volumeScale, pitchScale, intonationScale,
+                                           prePhonemeLength, postPhonemeLength, outputSamplingRate, print_error, stream)
+        if wave_data is None:
+            CoeiroinkApi.invalidate_status()
+        return wave_data
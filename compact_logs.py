@@ -0,0 +1,29 @@
+# ZundaGPT
+#
+# チャットログ圧縮ツール
+# 古いチャットのログファイルを、年月ごとの書庫ファイルにまとめて圧縮する
+# 使い方: python compact_logs.py [日数]（省略したときは設定ファイルの chat_log_archive_days）
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+import os
+import sys
+from datetime import datetime, timedelta
+
+from log_archive import compact_logs
+from settings import Settings
+
+settings = Settings("settings.json")
+settings.load()
+
+log_folder = settings.get_chat_log_folder()
+days = int(sys.argv[1]) if len(sys.argv) > 1 else settings.get_chat_log_archive_days()
+
+if log_folder == "" or not os.path.exists(log_folder):
+    print("ログフォルダがありません")
+    sys.exit()
+
+count = compact_logs(log_folder, datetime.now() - timedelta(days=days))
+print(f"{days}日より前のログ {count} 件を書庫にまとめました")
@@ -0,0 +1,118 @@
+# ZundaGPT
+#
+# 音声合成エンジン監視モジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+import threading
+import time
+from typing import Callable
+
+# 音声合成エンジン監視クラス
+# エンジンごとにバックグラウンドスレッドで起動状態を確認し、停止していれば起動する
+class EngineMonitor:
+    # 起動状態を確認する間隔（秒）
+    CHECK_INTERVAL = 5.0
+    # エンジンを起動してから立ち上がるまで確認する間隔（秒）
+    LAUNCH_CHECK_INTERVAL = 1.0
+    # エンジンを起動しなおすまでの最小間隔（秒）
+    LAUNCH_COOLDOWN = 30.0
+    # 立ち上がらないエンジンを起動しなおす最大回数（立ち上がったら数えなおす）
+    MAX_LAUNCHES = 3
+
+    _monitors = {}
+    _monitors_lock = threading.Lock()
+
+    def __init__(self, name: str, probe: Callable[[], bool], launch: Callable[[], bool] = None):
+        self.name = name
+        self._probe = probe
+        self._launch = launch
+        self._up = False
+        # 停止していたエンジンが起動した（再起動した）回数
+        self.start_count = 0
+        self._checked = False
+        self._launched_at = None
+        self._launch_count = 0
+        self._condition = threading.Condition()
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._worker, name=f"EngineMonitor-{name}", daemon=True)
+        self._thread.start()
+
+    # 監視を開始する（すでに監視中のエンジンならそのモニターを返す）
+    # probeは起動していればTrueを返す関数、launchはエンジンを起動できたらTrueを返す関数
+    @classmethod
+    def start(cls, name: str, probe: Callable[[], bool], launch: Callable[[], bool] = None) -> "EngineMonitor":
+        with cls._monitors_lock:
+            monitor = cls._monitors.get(name)
+            if monitor is None:
+                monitor = EngineMonitor(name, probe, launch)
+                cls._monitors[name] = monitor
+            return monitor
+
+    # 監視中のモニターを取得する
+    @classmethod
+    def get(cls, name: str) -> "EngineMonitor":
+        with cls._monitors_lock:
+            return cls._monitors.get(name)
+
+    # エンジンが起動しているかどうか（最後に確認した結果を返す）
+    def is_up(self) -> bool:
+        return self._up
+
+    # エンジンが起動するまで待つ
+    # 起動していないことが確認でき、かつ起動中でもなければタイムアウトを待たずに戻る
+    def wait_until_up(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while not self._up:
+                if self._checked and not self._is_launching():
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self._up
+
+    # すぐに起動状態を確認しなおす（通信に失敗したときなどに使う）
+    def request_check(self):
+        self._wakeup.set()
+
+    # 監視スレッド
+    def _worker(self):
+        while True:
+            self._check()
+            interval = EngineMonitor.LAUNCH_CHECK_INTERVAL if self._is_launching() else EngineMonitor.CHECK_INTERVAL
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+
+    # 起動状態を確認し、停止していれば起動する
+    def _check(self):
+        try:
+            up = bool(self._probe())
+        except Exception:
+            up = False
+
+        if up:
+            self._launched_at = None
+            self._launch_count = 0
+        elif self._launch is not None and not self._is_launching() and self._launch_count < EngineMonitor.MAX_LAUNCHES:
+            try:
+                if self._launch():
+                    self._launched_at = time.monotonic()
+                    self._launch_count += 1
+            except Exception:
+                pass
+
+        with self._condition:
+            if up and not self._up:
+                self.start_count += 1
+            self._up = up
+            self._checked = True
+            self._condition.notify_all()
+
+    # エンジンを起動して立ち上がりを待っている最中かどうか
+    def _is_launching(self) -> bool:
+        launched_at = self._launched_at
+        return launched_at is not None and time.monotonic() - launched_at < EngineMonitor.LAUNCH_COOLDOWN
@@ -0,0 +1,138 @@
+# ZundaGPT
+#
+# チャットログ書庫モジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+import gzip
+import io
+import json
+import os
+import struct
+from datetime import datetime
+from typing import Dict, Iterator, List, Tuple
+
+import chat_log
+
+# 書庫ファイルの名前の先頭と拡張子
+ARCHIVE_PREFIX = "chatarchive-"
+ARCHIVE_EXTENSION = ".zlog"
+
+# 書庫ファイルかどうか
+def is_archive(name: str) -> bool:
+    return name.startswith(ARCHIVE_PREFIX) and name.endswith(ARCHIVE_EXTENSION)
+
+# ログファイルをしまう書庫ファイルの名前を取得する（ログの日時の年月ごとにまとめる）
+def get_archive_name(logfile_name: str) -> str:
+    return ARCHIVE_PREFIX + logfile_name[8:14] + ARCHIVE_EXTENSION
+
+# 指定した日時より前のログファイルを書庫にしまう（しまったログの数を返す）
+# 以前のバージョンのログファイルはJSONL形式に変換してからしまう
+def compact_logs(folder: str, before: datetime) -> int:
+    groups = {}
+    for name in os.listdir(folder):
+        if not name.startswith("chatlog-"):
+            continue
+        try:
+            logtime = datetime.strptime(name[8:23], "%Y%m%d-%H%M%S")
+        except ValueError:
+            continue
+        if logtime < before:
+            groups.setdefault(get_archive_name(name), []).append(name)
+
+    count = 0
+    for archive_name, names in sorted(groups.items()):
+        path = os.path.join(folder, archive_name)
+        sessions = {}
+        if os.path.exists(path):
+            archive = LogArchive(path)
+            for name in archive.get_table():
+                sessions[name] = archive.read_raw(name)
+
+        for name in names:
+            messages = chat_log.read_messages(os.path.join(folder, name))
+            if chat_log.is_legacy_log(name):
+                name = name[:-len(chat_log.LEGACY_LOG_EXTENSION)] + chat_log.LOG_EXTENSION
+            sessions[name] = LogArchive.compress_messages(messages)
+
+        LogArchive.write(path, sorted(sessions.items()))
+        for name in names:
+            os.remove(os.path.join(folder, name))
+        count += len(names)
+    return count
+
+# チャットログ書庫クラス
+# 古いログファイルを会話ごとにgzipで圧縮してひとつのファイルにまとめる
+# ファイルの末尾に会話ごとの位置の一覧（オフセットテーブル）を置き、読み込むときは必要な会話だけを展開する
+#
+# ファイル形式: [gzipメンバー（会話ごと）]... [オフセットテーブル（JSON）] [テーブルの位置（8バイト）] [MAGIC]
+class LogArchive:
+    MAGIC = b"ZGLA"
+    VERSION = 1
+    TRAILER_SIZE = 8 + len(MAGIC)
+
+    def __init__(self, path: str):
+        self.path = path
+        self._table = None
+
+    # 書庫にある会話（ログファイル名 → (位置, 圧縮後のサイズ)）の一覧を取得する
+    def get_table(self) -> Dict[str, Tuple[int, int]]:
+        if self._table is None:
+            self._table = self._read_table()
+        return self._table
+
+    # 書庫にある会話のメッセージを順番に読み込む（その会話だけを展開する）
+    def read_messages(self, name: str) -> Iterator[dict]:
+        offset, length = self.get_table()[name]
+        with open(self.path, "rb") as file:
+            file.seek(offset)
+            data = file.read(length)
+        with io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(data)), encoding="utf-8") as text:
+            yield from chat_log.parse_messages(text)
+
+    # 圧縮したままの会話のデータを取得する
+    def read_raw(self, name: str) -> bytes:
+        offset, length = self.get_table()[name]
+        with open(self.path, "rb") as file:
+            file.seek(offset)
+            return file.read(length)
+
+    # 書庫ファイルを書き出す（sessionsは (ログファイル名, 圧縮済みのデータ) のリスト）
+    # 書き出し中に止まっても元の書庫が壊れないように、一時ファイルに書いてから置き換える
+    @staticmethod
+    def write(path: str, sessions: List[Tuple[str, bytes]]):
+        table = {}
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as file:
+            for name, data in sessions:
+                table[name] = [file.tell(), len(data)]
+                file.write(data)
+            table_offset = file.tell()
+            file.write(json.dumps({"version": LogArchive.VERSION, "sessions": table}, ensure_ascii=False).encode("utf-8"))
+            file.write(struct.pack("<Q", table_offset) + LogArchive.MAGIC)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+
+    # 会話のメッセージをJSONL形式にして圧縮する
+    @staticmethod
+    def compress_messages(messages) -> bytes:
+        lines = "".join(json.dumps(message, ensure_ascii=False) + "\n" for message in messages)
+        return gzip.compress(lines.encode("utf-8"), mtime=0)
+
+    # オフセットテーブルを読み込む
+    def _read_table(self):
+        with open(self.path, "rb") as file:
+            size = file.seek(0, os.SEEK_END)
+            if size < LogArchive.TRAILER_SIZE:
+                raise ValueError(f"書庫ファイルが壊れています: {self.path}")
+            file.seek(size - LogArchive.TRAILER_SIZE)
+            trailer = file.read(LogArchive.TRAILER_SIZE)
+            table_offset, magic = struct.unpack("<Q4s", trailer)
+            if magic != LogArchive.MAGIC:
+                raise ValueError(f"書庫ファイルではありません: {self.path}")
+            file.seek(table_offset)
+            header = json.loads(file.read(size - LogArchive.TRAILER_SIZE - table_offset).decode("utf-8"))
+        return {name: (offset, length) for name, (offset, length) in header["sessions"].items()}
@@ -0,0 +1,127 @@
+# ZundaGPT
+#
+# チャットログ索引モジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+import bisect
+import os
+import threading
+from typing import Iterator, Optional
+
+import chat_log
+import log_archive
+from log_archive import LogArchive
+
+# チャットログ索引クラス
+# ログファイルの名前（日時順に並ぶ）をソートして保持し、前後のログを二分探索で探す
+# フォルダの更新日時が変わったときだけ作りなおし、このアプリが作ったファイルは索引に直接追加する
+# 書庫にしまわれたログも、書庫のオフセットテーブルから索引に含める（同じ名前のログファイルがあればそちらを使う）
+class LogIndex:
+    LOGFILE_PREFIX = "chatlog-"
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self._names = []
+        self._archived = {}
+        self._archive_tables = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    # 指定したログより前（古い）のログの名前を取得する（なければNone）
+    # 索引にない名前を渡したときは、その名前の日時より前にある一番新しいログを返す
+    def get_prev(self, name: str) -> Optional[str]:
+        with self._lock:
+            self._refresh()
+            index = bisect.bisect_left(self._names, name)
+            return self._names[index - 1] if index > 0 else None
+
+    # 指定したログより後（新しい）のログの名前を取得する（なければNone）
+    def get_next(self, name: str) -> Optional[str]:
+        with self._lock:
+            self._refresh()
+            index = bisect.bisect_right(self._names, name)
+            return self._names[index] if index < len(self._names) else None
+
+    # ログがしまわれている書庫ファイルの名前を取得する（書庫になければNone）
+    def get_archive(self, name: str) -> Optional[str]:
+        with self._lock:
+            self._refresh()
+            return self._archived.get(name)
+
+    # ログのメッセージを順番に読み込む（書庫にしまわれていれば、その会話だけを展開する）
+    def read_messages(self, name: str) -> Iterator[dict]:
+        archive = self.get_archive(name)
+        if archive is None:
+            return chat_log.read_messages(os.path.join(self.folder, name))
+        return LogArchive(os.path.join(self.folder, archive)).read_messages(name)
+
+    # 作成したログファイルを索引に追加する
+    def add(self, name: str):
+        with self._lock:
+            self._refresh()
+            index = bisect.bisect_left(self._names, name)
+            if index == len(self._names) or self._names[index] != name:
+                self._names.insert(index, name)
+            self._archived.pop(name, None)
+            self._mtime = self._get_folder_mtime()
+
+    # 削除したログファイルを索引から取り除く
+    # 同じ名前のログが書庫にあるかもしれないので、次に使うときに作りなおす
+    def remove(self, name: str):
+        with self._lock:
+            self._mtime = None
+
+    # フォルダが外から変更されていたら索引を作りなおす
+    def _refresh(self):
+        mtime = self._get_folder_mtime()
+        if mtime is not None and mtime == self._mtime:
+            return
+
+        self._mtime = mtime
+        if mtime is None:
+            self._names = []
+            self._archived = {}
+            return
+
+        names = set()
+        archives = []
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.name.startswith(LogIndex.LOGFILE_PREFIX) and entry.is_file():
+                    names.add(entry.name)
+                elif log_archive.is_archive(entry.name) and entry.is_file():
+                    archives.append(entry)
+
+        self._archived = {}
+        tables = {}
+        for entry in sorted(archives, key=lambda entry: entry.name):
+            tables[entry.name] = self._get_archive_names(entry)
+            for name in tables[entry.name][1]:
+                if name not in names:
+                    self._archived[name] = entry.name
+
+        self._archive_tables = tables
+        self._names = sorted(names.union(self._archived))
+
+    # 書庫にしまわれているログの名前を取得する（書庫が変わっていなければ前回読んだ結果を使う）
+    def _get_archive_names(self, entry):
+        mtime = entry.stat().st_mtime_ns
+        cached = self._archive_tables.get(entry.name)
+        if cached is not None and cached[0] == mtime:
+            return cached
+
+        try:
+            names = list(LogArchive(entry.path).get_table())
+        except (OSError, ValueError):
+            names = []
+        return (mtime, names)
+
+    # フォルダの更新日時を取得する（フォルダがなければNone）
+    def _get_folder_mtime(self):
+        try:
+            return os.stat(self.folder).st_mtime_ns
+        except OSError:
+            return None
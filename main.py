@@ -6,16 +6,29 @@
 # このソースコードは MITライセンス の下でライセンスされています。
 # ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
 
-import os
+# 起動時間の計測のため、ほかのモジュールより先にインポートする
+import startup_profile
+
+import asyncio
 import sys
 from typing import List
 
-import openai
-
+import http_session
+import metrics
+from audio_cache import AudioCache
 from character import CharacterFactory
 from chat import ChatFactory
 from chat import Chat
+from chat_summarizer import ChatSummarizer
+from chat_viewer import ChatViewer
+from response_cache import ResponseCache
+from search_index import SearchIndex
+from sentence_segmenter import SentenceSegmenter
 from settings import Settings
+from sound import warm_up_sound
+from speech_pipeline import SpeechPipeline
+from startup import StartupOrchestrator
+from turn_engine import TurnEngine
 from voicevox_api import VoicevoxAPI
 from coeiroink_api import CoeiroinkApi
 
@@ -27,60 +40,151 @@ SETTING_FILE = "settings.json"
 settings = None
 assistant_character = None
 user_character = None
+speech_pipeline = None
+chat_viewer = None
 
 # メイン
 def main():
-    global settings, assistant_character, user_character
+    global settings, assistant_character, user_character, speech_pipeline, chat_viewer
 
     print_apptitle()
 
-    settings = Settings(SETTING_FILE)
-    settings.load()
+    with startup_profile.section("設定の読み込み"):
+        settings = Settings(SETTING_FILE)
+        settings.load()
     VoicevoxAPI.server = settings.get_voicevox_server()
+    VoicevoxAPI.batch_concurrency = settings.get_voicevox_batch_concurrency()
     CoeiroinkApi.server = settings.get_coeiroink_server()
+    with startup_profile.section("HTTPセッション"):
+        setup_http_sessions()
+    Chat.log_fsync_interval = settings.get_chat_log_fsync_interval()
+    with startup_profile.section("音声キャッシュ"):
+        CharacterFactory.audio_cache = AudioCache(settings.get_audio_cache_folder(), settings.get_audio_cache_size())
+    metrics.set_window(settings.get_metrics_window())
+    chat_viewer = ChatViewer(settings.get_chat_view_page_size(), print_apptitle, print_chat_message)
+
+    # チャットの作成と音声合成エンジンの起動を並行して行い、チャットの準備ができたらすぐに入力を受け付ける
+    # 音声合成エンジンの準備（起動の確認と、短い文の合成）はバックグラウンドで続ける
+    startup = StartupOrchestrator()
+    startup.start("chat", create_chat)
+    startup.start("assistant_character", CharacterFactory.create_assistant_character, settings)
+    startup.start("user_character", CharacterFactory.create_user_character, settings)
+    if uses_sound(settings.get_assistant_tts_software()) or uses_sound(settings.get_user_tts_software()):
+        startup.start("sound", warm_up_sound)
+    startup.shutdown()
 
     try:
-        chat = ChatFactory.create(
-                    settings.get_chat_api(),
-                    settings.get_chat_model(),
-                    settings.get_chat_instruction(),
-                    settings.get_chat_bad_response(),
-                    settings.get_chat_history_size(),
-                    settings.get_chat_log_folder())
+        with startup_profile.section("チャット"):
+            chat = startup.result("chat")
     except ValueError as err:
         print(err)
         sys.exit()
 
-    assistant_character = CharacterFactory.create_assistant_character(settings)
-    user_character = CharacterFactory.create_user_character(settings)
+    with startup_profile.section("キャラクター"):
+        assistant_character = startup.result("assistant_character")
+        user_character = startup.result("user_character")
+    speech_pipeline = SpeechPipeline()
+
+    if startup_profile.ENABLED:
+        with startup_profile.section("音声合成エンジンの準備"):
+            for character in (assistant_character, user_character):
+                if character is not None:
+                    character.wait_until_ready()
+        startup_profile.print_report()
+        chat.close()
+        return
+
+    engine = TurnEngine(
+        lambda: f"{settings.get_user_prompt()} > ",
+        lambda message: handle_input(message, chat),
+        speech_pipeline.clear)
+    try:
+        asyncio.run(engine.run())
+    finally:
+        # Ctrl+Cで終了するときも、書き込み待ちのログと計測結果を保存してから終了する
+        chat.close()
+        if settings.get_metrics_file() != "":
+            metrics.write_summary(settings.get_metrics_file(), version=APP_VERSION, model=settings.get_chat_model())
+
+# 音声合成ソフトがこのアプリで音声を再生するかどうか（A.I.VOICEは自分で再生する）
+def uses_sound(tts_software):
+    return tts_software == "VOICEVOX" or tts_software == "COEIROINK"
+
+# 設定に合わせてチャットを作成する
+def create_chat() -> Chat:
+    chat = ChatFactory.create(
+        settings.get_chat_api(),
+        settings.get_chat_model(),
+        settings.get_chat_instruction(),
+        settings.get_chat_bad_response(),
+        settings.get_chat_history_size(),
+        settings.get_chat_log_folder(),
+        SentenceSegmenter(
+            settings.get_sentence_min_length(),
+            settings.get_sentence_max_length(),
+            settings.get_sentence_first_clause_early()),
+        settings.get_chat_context_tokens())
+
+    if settings.get_chat_summary_enable():
+        chat.summarizer = ChatSummarizer(
+            chat.client,
+            settings.get_chat_summary_model() or settings.get_chat_model(),
+            settings.get_chat_summary_threshold(),
+            settings.get_chat_summary_max_tokens())
+
+    if settings.get_chat_log_folder() != "" and settings.get_chat_search_index_file() != "":
+        chat.search_index = SearchIndex(settings.get_chat_search_index_file(), settings.get_chat_log_folder())
+
+    if settings.get_chat_response_cache_enable():
+        chat.response_cache = ResponseCache(
+            settings.get_chat_response_cache_file(),
+            settings.get_chat_response_cache_ttl(),
+            settings.get_chat_response_cache_size())
+
+    return chat
+
+# 入力されたメッセージを処理する（チャットに送るときは、そのターンのコルーチンを返す）
+def handle_input(message, chat: Chat):
+    if message[0] == "@" or message[0] == "+" or message[0] == "-":
+        if exec_command(message, chat):
+            print()
+            return None
 
-    while True:
-        message = input(f"{settings.get_user_prompt()} > ")
-        if message[0] == "@" or message[0] == "+" or message[0] == "-":
-            if exec_command(message, chat):
-                print()
-                continue
+    print()
 
-        print()
+    # あなたのメッセージの読み上げより先にターンの計測を始める
+    metrics.start_turn()
+    if settings.get_user_echo_enable() and user_character is not None:
+        speech_pipeline.enqueue(user_character, message)
 
-        if settings.get_user_echo_enable() and user_character is not None:
-            try:
-                user_character.talk(message)
-            except:
-                pass
+    return run_turn(message, chat)
 
-        print(f"{settings.get_assistant_prompt()} > ")
-        try:
-            chat.send_message(message, outputChunk, outputSentence)
-            print()
-        except openai.AuthenticationError as err:
-            print("APIの認証に失敗しました")
-            print(err.message)
-            sys.exit()
-        except openai.NotFoundError as err:
-            print("デプロイメントが見つかりません")
-            print(err.message)
-            sys.exit()
+# メッセージを送信して、回答を表示・読み上げる
+async def run_turn(message, chat: Chat):
+    import openai
+
+    print(f"{settings.get_assistant_prompt()} > ")
+    try:
+        await chat.send_message_async(message, outputChunk, outputSentence)
+        print()
+        await asyncio.to_thread(speech_pipeline.wait)
+        metrics.mark_turn("turn.total")
+    except openai.AuthenticationError as err:
+        print("APIの認証に失敗しました")
+        print(err.message)
+        sys.exit()
+    except openai.NotFoundError as err:
+        print("デプロイメントが見つかりません")
+        print(err.message)
+        sys.exit()
+
+# 音声合成エンジンとのHTTPセッションを設定する
+def setup_http_sessions():
+    timeout = (settings.get_http_connect_timeout(), settings.get_http_read_timeout())
+    for api in (VoicevoxAPI, CoeiroinkApi):
+        api.session = http_session.create_session(
+            settings.get_http_pool_size(), settings.get_http_retries(), settings.get_http_backoff_factor())
+        api.timeout = timeout
 
 # チャット応答のチャンク出力用コールバック関数
 def outputChunk(chunk):
@@ -88,12 +192,10 @@ def outputChunk(chunk):
 
 # チャット応答のセンテンス読み上げ用コールバック関数
 def outputSentence(sentence):
+    metrics.mark_turn("turn.first_sentence")
     if settings.get_assistant_echo_enable() and assistant_character is not None:
-        try:
-            assistant_character.talk(sentence)
-        except:
-            pass
-    if not sentence.endswith("\n"):
+        speech_pipeline.enqueue(assistant_character, sentence, reply=True)
+    if not sentence.endswith("\n") and SentenceSegmenter.is_sentence_end(sentence):
         print()
 
 # タイトルを表示する
@@ -141,6 +243,16 @@ def exec_command(command, chat):
         exec_command_prev(chat)
     elif words[0] == "@next" or words[0] == "+":
         exec_command_next(chat)
+    elif words[0] == "@search":
+        exec_command_search(command, chat)
+    elif words[0] == "@summary":
+        exec_command_summary(chat)
+    elif words[0] == "@stats":
+        exec_command_stats()
+    elif words[0] == "@older":
+        exec_command_older(chat)
+    elif words[0] == "@newer":
+        exec_command_newer(chat)
     else:
         return False
 
@@ -205,7 +317,7 @@ def exec_command_assistant_tts_software(words: List[str]):
         if val == "VOICEVOX" or val == "AIVOICE" or val == "COEIROINK":
             settings.set_assistant_tts_software(val)
             settings.save()
-            assistant_character = CharacterFactory.create_assistant_character(settings)
+            assistant_character = CharacterFactory.update_assistant_character(assistant_character, settings)
             print(f"assistant_tts_softwareを '{val}' に変更したのだ")
         else:
             print("無効なコマンドなのだ")
@@ -220,7 +332,7 @@ def exec_command_assistant_speaker_id(words: List[str]):
         val = " ".join(words[1:])
         settings.set_assistant_speaker_id(val)
         settings.save()
-        assistant_character = CharacterFactory.create_assistant_character(settings)
+        assistant_character = CharacterFactory.update_assistant_character(assistant_character, settings)
         print(f"assistant_speaker_idを '{val}' に変更したのだ")
 
 # assistant_speed_scaleの設定
@@ -234,7 +346,7 @@ def exec_command_assistant_speed_scale(words: List[str]):
             val = float(words[1])
             settings.set_assistant_speed_scale(val)
             settings.save()
-            assistant_character = CharacterFactory.create_assistant_character(settings)
+            assistant_character = CharacterFactory.update_assistant_character(assistant_character, settings)
             print(f"assistant_speed_scaleを {val} に変更したのだ")
         except:
             print("無効なコマンドなのだ")
@@ -250,7 +362,7 @@ def exec_command_assistant_pitch_scale(words: List[str]):
             val = float(words[1])
             settings.set_assistant_pitch_scale(val)
             settings.save()
-            assistant_character = CharacterFactory.create_assistant_character(settings)
+            assistant_character = CharacterFactory.update_assistant_character(assistant_character, settings)
             print(f"assistant_pitch_scaleを {val} に変更したのだ")
         except:
             print("無効なコマンドなのだ")
@@ -314,7 +426,7 @@ def exec_command_user_tts_software(words: List[str]):
         if val == "VOICEVOX" or val == "AIVOICE" or val == "COEIROINK":
             settings.set_user_tts_software(val)
             settings.save()
-            user_character = CharacterFactory.create_user_character(settings)
+            user_character = CharacterFactory.update_user_character(user_character, settings)
             print(f"user_tts_softwareを '{val}' に変更したのだ")
         else:
             print("無効なコマンドなのだ")
@@ -329,7 +441,7 @@ def exec_command_user_speaker_id(words: List[str]):
         val = " ".join(words[1:])
         settings.set_user_speaker_id(val)
         settings.save()
-        user_character = CharacterFactory.create_user_character(settings)
+        user_character = CharacterFactory.update_user_character(user_character, settings)
         print(f"user_speaker_idを '{val}' に変更したのだ")
 
 # user_speed_scaleの設定
@@ -343,7 +455,7 @@ def exec_command_user_speed_scale(words: List[str]):
             val = float(words[1])
             settings.set_user_speed_scale(val)
             settings.save()
-            user_character = CharacterFactory.create_user_character(settings)
+            user_character = CharacterFactory.update_user_character(user_character, settings)
             print(f"user_speed_scaleを {val} に変更したのだ")
         except:
             print("無効なコマンドなのだ")
@@ -359,7 +471,7 @@ def exec_command_user_pitch_scale(words: List[str]):
             val = float(words[1])
             settings.set_user_pitch_scale(val)
             settings.save()
-            user_character = CharacterFactory.create_user_character(settings)
+            user_character = CharacterFactory.update_user_character(user_character, settings)
             print(f"user_pitch_scaleを {val} に変更したのだ")
         except:
             print("無効なコマンドなのだ")
@@ -374,18 +486,79 @@ def exec_command_next(chat: Chat):
     chat.load_next()
     print_chat_messages(chat)
 
-# チャットメッセージ全体の再表示
+# チャット記録を検索して、一番よく合う記録を読み込む
+def exec_command_search(command: str, chat: Chat):
+    words = command.split(maxsplit=1)
+    if len(words) == 1:
+        print("検索する言葉を指定してほしいのだ")
+        return
+    if chat.search_index is None:
+        print("チャットの記録を検索できない設定なのだ")
+        return
+
+    query = words[1]
+    results = chat.search_index.search(query)
+    if len(results) == 0:
+        print(f"'{query}' は見つからなかったのだ")
+        return
+
+    chat.load_log(results[0].name)
+    print_chat_messages(chat)
+    print(f"'{query}' で見つかった記録なのだ（{results[0].name} を表示中）")
+    for result in results:
+        print(f"  {result.name} : {result.snippet}")
+
+# 会話の要約と、要約で減らした送信トークン数の表示
+def exec_command_summary(chat: Chat):
+    if chat.summarizer is None:
+        print("要約は無効になっているのだ")
+    elif chat.summary is None:
+        print("まだ要約はないのだ")
+    else:
+        print(chat.summary)
+
+    print()
+    print(f"前回の送信トークン数 : {chat.last_prompt_tokens}（全部の会話を送ると {chat.last_full_prompt_tokens}）")
+    if chat.total_full_prompt_tokens > 0:
+        saved = chat.total_full_prompt_tokens - chat.total_prompt_tokens
+        print(f"累計で減らしたトークン数 : {saved}（{saved * 100 // chat.total_full_prompt_tokens}%）")
+
+# 表示中のページより古いチャットメッセージの表示
+def exec_command_older(chat: Chat):
+    if not chat_viewer.show_older(chat.messages):
+        print("これより前のメッセージはないのだ")
+
+# 表示中のページより新しいチャットメッセージの表示
+def exec_command_newer(chat: Chat):
+    if not chat_viewer.show_newer(chat.messages):
+        print("これより後のメッセージはないのだ")
+
+# 計測結果の表示（時間はミリ秒、chat.tokens_per_secは1秒あたりのトークン数）
+def exec_command_stats():
+    summary = metrics.summary()
+    if len(summary) == 0:
+        print("まだ計測結果はないのだ")
+        return
+
+    print(f"{'name':<28} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for name, values in summary.items():
+        if "p50" not in values:
+            continue
+        print(f"{name:<28} {values['count']:>6} {values['p50']:>9.1f} {values['p95']:>9.1f} {values['p99']:>9.1f}")
+
+# チャットメッセージの再表示（最新のページだけを表示する）
 def print_chat_messages(chat: Chat):
-    os.system('cls' if os.name == 'nt' else 'clear')
-    print_apptitle()
-    for message in chat.messages:
-        if message["role"] == "user":
-            print(f"{settings.get_user_prompt()} > {message["content"]}")
-            print("")
-        elif message["role"] == "assistant":
-            print(f"{settings.get_assistant_prompt()} > ")
-            print(message["content"])
-            print("")
+    chat_viewer.show_latest(chat.messages)
+
+# チャットメッセージの表示
+def print_chat_message(message):
+    if message["role"] == "user":
+        print(f"{settings.get_user_prompt()} > {message["content"]}")
+        print("")
+    elif message["role"] == "assistant":
+        print(f"{settings.get_assistant_prompt()} > ")
+        print(message["content"])
+        print("")
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,147 @@
+# ZundaGPT
+#
+# 計測モジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+import contextlib
+import json
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+# 計測値の分布クラス
+# 直近の計測値だけを保持して、パーセンタイルを計算する
+class Histogram:
+    def __init__(self, window: int):
+        self.count = 0
+        self._values = deque(maxlen=window)
+
+    # 計測値を追加する
+    def add(self, value: float):
+        self.count += 1
+        self._values.append(value)
+
+    # 直近の計測値の集計を取得する
+    def summary(self) -> dict:
+        values = sorted(self._values)
+        if len(values) == 0:
+            return {"count": self.count}
+        return {
+            "count": self.count,
+            "p50": Histogram._percentile(values, 50),
+            "p95": Histogram._percentile(values, 95),
+            "p99": Histogram._percentile(values, 99),
+            "max": values[-1],
+        }
+
+    # ソート済みの値のパーセンタイルを求める（最近傍順位法）
+    @staticmethod
+    def _percentile(values, percent):
+        index = max(0, -(-len(values) * percent // 100) - 1)
+        return values[index]
+
+# 計測クラス
+# 会話のターンのどこで時間がかかっているかを調べるため、処理時間などを名前ごとに記録する
+# 時間はミリ秒で記録する
+class Metrics:
+    # 名前ごとに保持する直近の計測値の数
+    DEFAULT_WINDOW = 1000
+
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        self.window = window
+        self._histograms = {}
+        self._turn_start = None
+        self._turn_marks = set()
+        self._lock = threading.Lock()
+
+    # 計測値を記録する
+    def record(self, name: str, value: float):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = Histogram(self.window)
+                self._histograms[name] = histogram
+            histogram.add(value)
+
+    # 処理時間を記録する
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000)
+
+    # ターンの開始を記録する
+    def start_turn(self):
+        with self._lock:
+            self._turn_start = time.perf_counter()
+            self._turn_marks = set()
+
+    # ターンの開始からの時間を記録する（同じ名前はターンごとに最初の1回だけ記録する）
+    def mark_turn(self, name: str):
+        with self._lock:
+            if self._turn_start is None or name in self._turn_marks:
+                return
+            self._turn_marks.add(name)
+            elapsed = (time.perf_counter() - self._turn_start) * 1000
+        self.record(name, elapsed)
+
+    # 記録した計測値をすべて破棄する
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self._turn_start = None
+            self._turn_marks = set()
+
+    # 名前ごとの集計を取得する
+    def summary(self) -> dict:
+        with self._lock:
+            return {name: histogram.summary() for name, histogram in sorted(self._histograms.items())}
+
+    # 集計をJSONL形式のファイルに1行追記する
+    def write_summary(self, path: str, **extra):
+        record = {"time": datetime.now().isoformat(timespec="seconds")}
+        record.update(extra)
+        record["metrics"] = self.summary()
+        with open(path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+# アプリ全体で使う計測
+_metrics = Metrics()
+
+# 直近の計測値を保持する数を設定する（設定より前に記録した名前には反映されない）
+def set_window(window: int):
+    _metrics.window = window
+
+# 計測値を記録する
+def record(name: str, value: float):
+    _metrics.record(name, value)
+
+# 処理時間を記録する
+def timer(name: str):
+    return _metrics.timer(name)
+
+# ターンの開始を記録する
+def start_turn():
+    _metrics.start_turn()
+
+# ターンの開始からの時間を記録する
+def mark_turn(name: str):
+    _metrics.mark_turn(name)
+
+# 記録した計測値をすべて破棄する
+def reset():
+    _metrics.reset()
+
+# 名前ごとの集計を取得する
+def summary() -> dict:
+    return _metrics.summary()
+
+# 集計をファイルに追記する
+def write_summary(path: str, **extra):
+    _metrics.write_summary(path, **extra)
@@ -0,0 +1,85 @@
+# ZundaGPT
+#
+# チャット応答キャッシュモジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Optional
+
+# チャット応答キャッシュクラス
+# 同じAPI・モデルに同じメッセージ（指示文、過去の会話、質問）を送ったときの回答を保存しておき、再利用する
+# 保存してから一定時間が経った回答は使わず、件数が上限を超えたら最後に使われたのが古いものから削除する
+class ResponseCache:
+    def __init__(self, db_path: str, ttl: float, max_entries: int):
+        # ttlは回答を使う期間（秒）、max_entriesは保存する回答の最大件数
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, content TEXT NOT NULL, "
+                           "created REAL NOT NULL, last_used REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._conn.commit()
+
+    # キャッシュのキーを作成する（メッセージの前後の空白や全角半角の違いは無視する）
+    @staticmethod
+    def make_key(api: str, model: str, messages) -> str:
+        normalized = [[message["role"], ResponseCache._normalize(message["content"])] for message in messages]
+        data = json.dumps([api, model, normalized], ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    # 保存された回答を取得する（なければNone）
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT content, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    # 回答を保存する
+    def put(self, key: str, content: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO responses (key, content, created, last_used) VALUES (?, ?, ?, ?)",
+                               (key, content, now, now))
+            self._evict(now)
+            self._conn.commit()
+
+    # データベースを閉じる
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # 期限切れの回答と、上限を超えた古い回答を削除する
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute("DELETE FROM responses WHERE key IN "
+                               "(SELECT key FROM responses ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+
+    # テキストを比較用に正規化する
+    @staticmethod
+    def _normalize(text: str) -> str:
+        return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
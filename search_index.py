@@ -0,0 +1,330 @@
+# ZundaGPT
+#
+# チャットログ検索モジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+from typing import List, NamedTuple
+
+import chat_log
+import log_archive
+from log_archive import LogArchive
+
+# 検索結果
+class SearchResult(NamedTuple):
+    name: str
+    score: float
+    snippet: str
+
+# テキストを検索用に正規化する（全角英数や大文字小文字の違いをなくす）
+def normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", text).lower()
+
+# テキストを正規化して、正規化した文字ごとに元のテキストでの位置を返す
+# NFKCは文字数を変える（半角カナの濁点や合字など）ので、正規化したテキストで見つけた位置を元のテキストに戻すのに使う
+# 濁点のように前の文字と合わさる文字は、前の文字とまとめて正規化する
+def normalize_with_offsets(text: str):
+    normalized = []
+    offsets = []
+    start = 0
+    for index in range(1, len(text) + 1):
+        if index < len(text):
+            char = unicodedata.normalize("NFKC", text[index])
+            if char == "" or unicodedata.combining(char[0]):
+                continue
+        for char in normalize(text[start:index]):
+            normalized.append(char)
+            offsets.append(start)
+        start = index
+    return "".join(normalized), offsets
+
+# テキストをトークンに分けて、出現回数を数える
+# 日本語は単語の区切りがないので、文字の並びで索引を作る
+# 索引には1文字ずつのトークンと2文字ずつのトークン（bigram）を入れ、検索では2文字以上の語をbigramで、1文字の語はその1文字で探す
+def tokenize(text: str, for_query: bool = False) -> Counter:
+    grams = Counter()
+    for word in re.findall(r"\w+", normalize(text)):
+        if not for_query or len(word) == 1:
+            grams.update(word)
+        for index in range(len(word) - 1):
+            grams[word[index:index + 2]] += 1
+    return grams
+
+# チャットログ検索クラス
+# ログフォルダのメッセージから転置索引（トークン → ログファイルごとの出現回数）を作り、SQLiteに保存する
+# 索引はファイルごとに読み込んだバイト数を覚えていて、追記された分だけを追加する
+# 書庫にしまわれたログも索引に含める（書庫のログは、書庫の中のサイズが変わったときに最初から読みなおす）
+class SearchIndex:
+    SCHEMA_VERSION = 2
+    # 検索結果の候補として、実際にログを読んで語が含まれているか確認する最大数
+    MAX_VERIFY = 50
+    SNIPPET_LENGTH = 40
+    # 索引をまとめて作るときに、一度に書き込むトークンの数
+    BULK_INSERT_SIZE = 500000
+
+    def __init__(self, db_path: str, log_folder: str):
+        self.db_path = db_path
+        self.log_folder = log_folder
+        self._lock = threading.Lock()
+        self._synced_mtime = None
+        self._archives = {}
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._init_db()
+
+    # ログファイルの追記された部分を索引に追加する
+    def index_file(self, name: str):
+        with self._lock:
+            try:
+                self._index_file(name)
+                self._conn.commit()
+            except (sqlite3.Error, OSError):
+                self._conn.rollback()
+                return
+
+            # 自分で追加したファイルのためにフォルダ全体を調べなおさなくていいようにする
+            if self._synced_mtime is not None:
+                self._synced_mtime = self._get_folder_mtime()
+
+    # ログファイルを索引から取り除く
+    def remove_file(self, name: str):
+        with self._lock:
+            try:
+                self._remove_file(name)
+                self._conn.commit()
+            except sqlite3.Error:
+                self._conn.rollback()
+
+    # 語を含むログファイルを、関連度の高い順に検索する
+    def search(self, query: str, limit: int = 10) -> List[SearchResult]:
+        terms = [normalize(term) for term in query.split()]
+        grams = tokenize(query, for_query=True)
+        if len(grams) == 0:
+            return []
+
+        with self._lock:
+            self._sync()
+            candidates = self._rank(grams)
+
+        results = []
+        for name, archive, score in candidates[:SearchIndex.MAX_VERIFY]:
+            snippet = self._find_snippet(name, archive, terms)
+            if snippet is not None:
+                results.append(SearchResult(name, score, snippet))
+                if len(results) >= limit:
+                    break
+        return results
+
+    # データベースを閉じる
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # テーブルを作成する（形式が古ければ作りなおす）
+    def _init_db(self):
+        conn = self._conn
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != SearchIndex.SCHEMA_VERSION:
+            conn.execute("DROP TABLE IF EXISTS files")
+            conn.execute("DROP TABLE IF EXISTS postings")
+        conn.execute("CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, archive TEXT, size INTEGER NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS postings (gram TEXT NOT NULL, file_id INTEGER NOT NULL, count INTEGER NOT NULL, "
+                     "PRIMARY KEY (gram, file_id)) WITHOUT ROWID")
+        conn.execute(f"PRAGMA user_version={SearchIndex.SCHEMA_VERSION}")
+        conn.commit()
+
+    # ログフォルダが外から変更されていたら、索引を追いつかせる
+    def _sync(self):
+        mtime = self._get_folder_mtime()
+        if mtime is None or mtime == self._synced_mtime:
+            return
+
+        indexed = {name: (archive, size) for name, archive, size in self._conn.execute("SELECT name, archive, size FROM files")}
+        names = set()
+        archives = []
+        new_postings = []
+        with os.scandir(self.log_folder) as entries:
+            for entry in entries:
+                if log_archive.is_archive(entry.name):
+                    archives.append(entry.name)
+                if not entry.name.startswith("chatlog-") or not entry.is_file():
+                    continue
+                names.add(entry.name)
+                if indexed.get(entry.name) != (None, entry.stat().st_size):
+                    self._index_file(entry.name, new_postings)
+                    if len(new_postings) >= SearchIndex.BULK_INSERT_SIZE:
+                        self._insert_new_postings(new_postings)
+
+        for archive in sorted(archives):
+            for name, (_, length) in self._get_archive_table(archive).items():
+                if name in names:
+                    continue
+                names.add(name)
+                if indexed.get(name) != (archive, length):
+                    self._index_file(name, new_postings, archive)
+                    if len(new_postings) >= SearchIndex.BULK_INSERT_SIZE:
+                        self._insert_new_postings(new_postings)
+
+        self._insert_new_postings(new_postings)
+        for name in indexed.keys() - names:
+            self._remove_file(name)
+
+        self._conn.commit()
+        self._synced_mtime = mtime
+
+    # ログファイルのまだ索引にない部分を追加する
+    # JSONL形式は前回の続きから、以前のJSON配列形式やサイズが減ったファイルは最初から読み込む
+    # new_postingsを渡すと、最初から読み込んだファイルのトークンはすぐに書き込まずにそこへ追加する
+    def _index_file(self, name: str, new_postings: list = None, archive: str = None):
+        if archive is None:
+            path = os.path.join(self.log_folder, name)
+            file_size = os.path.getsize(path)
+        else:
+            file_size = self._get_archive_table(archive)[name][1]
+
+        row = self._conn.execute("SELECT id, archive, size FROM files WHERE name = ?", (name,)).fetchone()
+        if row is not None and row[1] == archive and row[2] == file_size:
+            return
+
+        if row is None or row[1] != archive or archive is not None or chat_log.is_legacy_log(name) or file_size < row[2]:
+            self._remove_file(name)
+            file_id = self._conn.execute("INSERT INTO files (name, archive, size) VALUES (?, ?, 0)", (name, archive)).lastrowid
+            offset = 0
+        else:
+            file_id, _, offset = row
+
+        if archive is not None:
+            messages = list(self._get_archive(archive).read_messages(name))
+            size = file_size
+        elif chat_log.is_legacy_log(name):
+            messages = list(chat_log.read_messages(path))
+            size = file_size
+        else:
+            messages, size = SearchIndex._read_appended_messages(path, offset)
+
+        grams = Counter()
+        for message in messages:
+            grams.update(tokenize(message.get("content", "")))
+        self._conn.execute("UPDATE files SET size = ? WHERE id = ?", (size, file_id))
+
+        if offset == 0 and new_postings is not None:
+            new_postings.extend((gram, file_id, count) for gram, count in grams.items())
+            return
+        self._conn.executemany(
+            "INSERT INTO postings (gram, file_id, count) VALUES (?, ?, ?) "
+            "ON CONFLICT (gram, file_id) DO UPDATE SET count = count + excluded.count",
+            ((gram, file_id, count) for gram, count in grams.items()))
+
+    # 新しく索引に入れるファイルのトークンを、索引の並び順にそろえてまとめて書き込む
+    def _insert_new_postings(self, new_postings: list):
+        new_postings.sort()
+        self._conn.executemany("INSERT INTO postings (gram, file_id, count) VALUES (?, ?, ?)", new_postings)
+        new_postings.clear()
+
+    # ログファイルを索引から取り除く
+    def _remove_file(self, name: str):
+        row = self._conn.execute("SELECT id FROM files WHERE name = ?", (name,)).fetchone()
+        if row is not None:
+            self._conn.execute("DELETE FROM postings WHERE file_id = ?", row)
+            self._conn.execute("DELETE FROM files WHERE id = ?", row)
+
+    # トークンを多く含み、ほかのログにあまり出てこないトークンを含むものほど高い点数をつける（TF-IDF）
+    # すべてのトークンを含むログだけを返す
+    def _rank(self, grams: Counter):
+        file_count = self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        scores = None
+        for gram in grams:
+            postings = self._conn.execute("SELECT file_id, count FROM postings WHERE gram = ?", (gram,)).fetchall()
+            if len(postings) == 0:
+                return []
+
+            idf = math.log(1 + file_count / len(postings))
+            gram_scores = {file_id: (1 + math.log(count)) * idf for file_id, count in postings}
+            if scores is None:
+                scores = gram_scores
+            else:
+                scores = {file_id: score + gram_scores[file_id] for file_id, score in scores.items() if file_id in gram_scores}
+            if len(scores) == 0:
+                return []
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:SearchIndex.MAX_VERIFY]
+        files = {file_id: (name, archive) for file_id, name, archive in self._conn.execute(
+            f"SELECT id, name, archive FROM files WHERE id IN ({','.join('?' * len(ranked))})", [file_id for file_id, _ in ranked])}
+        return [(*files[file_id], score) for file_id, score in ranked if file_id in files]
+
+    # ログを読んで、すべての語を含むメッセージの一部を取り出す（語がそろっていなければNone）
+    def _find_snippet(self, name: str, archive: str, terms: List[str]):
+        try:
+            if archive is None:
+                messages = list(chat_log.read_messages(os.path.join(self.log_folder, name)))
+            else:
+                messages = list(self._get_archive(archive).read_messages(name))
+        except (OSError, ValueError, KeyError):
+            return None
+
+        found = set()
+        snippet = None
+        for message in messages:
+            content = message.get("content", "")
+            normalized = normalize(content)
+            matched = [term for term in terms if term in normalized]
+            if matched and snippet is None:
+                mapped, offsets = normalize_with_offsets(content)
+                index = mapped.find(matched[0])
+                position = max((offsets[index] if index >= 0 else 0) - SearchIndex.SNIPPET_LENGTH // 4, 0)
+                snippet = content[position:position + SearchIndex.SNIPPET_LENGTH].replace("\n", " ")
+            found.update(matched)
+        return snippet if len(found) == len(set(terms)) else None
+
+    # ファイルの指定した位置から後に追記されたメッセージを読み込む（最後の改行までを読み、読み終えた位置も返す）
+    @staticmethod
+    def _read_appended_messages(path, offset):
+        with open(path, "rb") as file:
+            file.seek(offset)
+            data = file.read()
+
+        end = data.rfind(b"\n") + 1
+        messages = []
+        for line in data[:end].decode("utf-8", errors="replace").splitlines():
+            line = line.strip()
+            if line:
+                try:
+                    messages.append(json.loads(line))
+                except json.JSONDecodeError:
+                    pass
+        return messages, offset + end
+
+    # 書庫を開く（書庫が変わっていなければ、前回読んだオフセットテーブルを使う）
+    def _get_archive(self, archive: str) -> LogArchive:
+        path = os.path.join(self.log_folder, archive)
+        mtime = os.stat(path).st_mtime_ns
+        cached = self._archives.get(archive)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, LogArchive(path))
+            self._archives[archive] = cached
+        return cached[1]
+
+    # 書庫のオフセットテーブルを取得する（読み込めなければ空）
+    def _get_archive_table(self, archive: str):
+        try:
+            return self._get_archive(archive).get_table()
+        except (OSError, ValueError):
+            return {}
+
+    # ログフォルダの更新日時を取得する（フォルダがなければNone）
+    def _get_folder_mtime(self):
+        try:
+            return os.stat(self.log_folder).st_mtime_ns
+        except OSError:
+            return None
@@ -0,0 +1,154 @@
+# ZundaGPT
+#
+# 読み上げ文分割モジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+from typing import List, Optional, Tuple
+
+# 読み上げ文分割クラス
+# チャットの応答を受信しながら、読み上げに使う文（セグメント）に区切る
+class SentenceSegmenter:
+    DEFAULT_MIN_LENGTH = 5
+    DEFAULT_MAX_LENGTH = 80
+
+    SENTENCE_TERMINATORS = "。？！"
+    ASCII_TERMINATORS = ".?!"
+    CLAUSE_DELIMITERS = "、，,"
+    OPEN_QUOTES = "「『（“("
+    CLOSE_QUOTES = "」』）”)"
+    SPACES = " \t　"
+    CODE_FENCE = "```"
+
+    def __init__(self, min_length=DEFAULT_MIN_LENGTH, max_length=DEFAULT_MAX_LENGTH, first_clause_early=False):
+        self.min_length = min_length
+        self.max_length = max(max_length, min_length, 1)
+        self.first_clause_early = first_clause_early
+        self.reset()
+
+    # 状態を初期化する（応答ごとに呼び出す）
+    def reset(self):
+        self._current = []
+        self._segment_count = 0
+        self._quote_depth = 0
+        self._in_code = False
+        self._backtick_run = 0
+        self._soft_break = None
+        # 文末を見つけて、続く文字を確認してから区切ろうとしている状態
+        # "strong" は続く文字が文末記号・閉じ括弧・空白以外なら区切る
+        # "weak" は英文のピリオドや括弧内の文末などで、続く文字が空白なら "strong" になり、それ以外なら区切らない
+        self._pending = None
+
+    # 受信したテキストを追加する
+    # 戻り値は (テキストの断片, 断片の終わりで区切れた文またはNone) のリストで、断片をつなげると元のテキストになる
+    def feed(self, text: str) -> List[Tuple[str, Optional[str]]]:
+        results = []
+        piece_start = 0
+        for index, char in enumerate(text):
+            if self._pending is not None and not self._continues_pending(char):
+                results.append((text[piece_start:index], self._take_segment()))
+                piece_start = index
+
+            self._append(char)
+
+            if self._should_break_after(char):
+                results.append((text[piece_start:index + 1], self._take_segment(self._get_break_position())))
+                piece_start = index + 1
+
+        if piece_start < len(text):
+            results.append((text[piece_start:], None))
+        return results
+
+    # 残っているテキストを文として取り出す（読み上げる内容がなければNone）
+    def flush(self) -> Optional[str]:
+        return self._take_segment()
+
+    # 文の終わりで区切れたセグメントかどうか（読点などの途中で区切れたものはFalse）
+    @staticmethod
+    def is_sentence_end(segment: str) -> bool:
+        text = segment.rstrip(SentenceSegmenter.SPACES).rstrip(SentenceSegmenter.CLOSE_QUOTES)
+        return text.endswith(tuple(SentenceSegmenter.SENTENCE_TERMINATORS + SentenceSegmenter.ASCII_TERMINATORS))
+
+    # 一文字追加して状態を更新する
+    def _append(self, char):
+        self._current.append(char)
+
+        if char == "`":
+            self._backtick_run += 1
+            if self._backtick_run == len(SentenceSegmenter.CODE_FENCE):
+                self._in_code = not self._in_code
+                self._backtick_run = 0
+        else:
+            self._backtick_run = 0
+
+        if self._in_code:
+            return
+
+        if char in SentenceSegmenter.OPEN_QUOTES:
+            self._quote_depth += 1
+        elif char in SentenceSegmenter.CLOSE_QUOTES:
+            self._quote_depth = max(self._quote_depth - 1, 0)
+        elif char in SentenceSegmenter.CLAUSE_DELIMITERS and self._quote_depth == 0:
+            self._soft_break = len(self._current)
+
+        if self._quote_depth > 0 or len(self._current) < self.min_length:
+            return
+
+        if char in SentenceSegmenter.SENTENCE_TERMINATORS:
+            self._pending = "strong"
+        elif char in SentenceSegmenter.ASCII_TERMINATORS and self._pending is None:
+            self._pending = "weak"
+        elif char in SentenceSegmenter.CLOSE_QUOTES and len(self._current) >= 2 and self._pending is None:
+            # 「〜。」と言った のように続くこともあるので、空白や改行が続いたときだけ区切る
+            if self._current[-2] in SentenceSegmenter.SENTENCE_TERMINATORS:
+                self._pending = "weak"
+
+    # 文末の後に続く文字が、まだその文の一部かどうか
+    def _continues_pending(self, char):
+        if char in SentenceSegmenter.SPACES or char == "\n":
+            self._pending = "strong"
+            return True
+        if char in SentenceSegmenter.SENTENCE_TERMINATORS + SentenceSegmenter.CLOSE_QUOTES:
+            return True
+        if char in SentenceSegmenter.ASCII_TERMINATORS:
+            return True
+        if self._pending == "weak":
+            self._pending = None
+            return True
+        return False
+
+    # 追加した文字の直後で区切るかどうか
+    def _should_break_after(self, char):
+        length = len(self._current)
+        if char == "\n":
+            return length >= self.min_length and "".join(self._current).strip() != ""
+        if length >= self.max_length:
+            return True
+        if self._in_code or self._quote_depth > 0:
+            return False
+        if self.first_clause_early and self._segment_count == 0 and char in SentenceSegmenter.CLAUSE_DELIMITERS:
+            return length >= self.min_length
+        return False
+
+    # 区切る位置を取得する（長すぎる文は、最後の読点の位置で区切る）
+    def _get_break_position(self):
+        if len(self._current) >= self.max_length and self._current[-1] != "\n" and self._soft_break:
+            return self._soft_break
+        return len(self._current)
+
+    # 区切る位置までを文として取り出す（空白しかなければNone）
+    def _take_segment(self, position=None):
+        if position is None:
+            position = len(self._current)
+
+        segment = "".join(self._current[:position])
+        self._current = self._current[position:]
+        self._soft_break = None
+        self._pending = None
+
+        if segment.strip() == "":
+            return None
+        self._segment_count += 1
+        return segment
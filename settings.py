@@ -6,325 +6,493 @@
 # このソースコードは MITライセンス の下でライセンスされています。
 # ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
 
+import atexit
 import json
 import os
 import threading
+from types import MappingProxyType
 
+import http_session
+from sentence_segmenter import SentenceSegmenter
 from voicevox_api import VoicevoxAPI
 from coeiroink_api import CoeiroinkApi
 
 class Settings:
-    FILE_VER = 5
+    FILE_VER = 17
+    # 音声合成ソフトの既定のインストール先
+    DEFAULT_VOICEVOX_PATH = "%LOCALAPPDATA%/Programs/VOICEVOX/VOICEVOX.exe"
+    DEFAULT_AIVOICE_PATH = "%ProgramW6432%/AI/AIVoice/AIVoiceEditor/AI.Talk.Editor.Api.dll"
+    # 設定を変更してから設定ファイルに書き込むまでの時間（秒）
+    SAVE_DELAY = 0.5
 
     def __init__(self, setting_file_path):
         self._setting_file_path = setting_file_path
         self._lock = threading.Lock()
-        self._init_member()
-
-    def _init_member(self):
-        self._assistant_prompt = "ずんだ"
-        self._assistant_echo = True
-        self._assistant_tts_software = "VOICEVOX"
-        self._assistant_speaker_id = "3"    # ずんだもん
-        self._assistant_speed_scale = 1.2
-        self._assistant_pitch_scale = 0.0
-        self._user_prompt = "あなた"
-        self._user_echo = True
-        self._user_tts_software = "VOICEVOX"
-        self._user_speaker_id = "13"    # 青山龍星
-        self._user_speed_scale = 1.2
-        self._user_pitch_scale = 0.0
-        self._chat_api = "OpenAI"
-        self._chat_model = "gpt-3.5-turbo-1106"
-        self._chat_instruction = "君は優秀なアシスタント。ずんだもんの話し方で話す。具体的には語尾に「のだ」または「なのだ」をつけて自然に話す。回答は１００文字以内で簡潔に行う。"
-        self._chat_bad_response = "答えられないのだ"
-        self._chat_history_size = 6
-        self._chat_log_folder = "log"
-        self._voicevox_server = VoicevoxAPI.DEFAULT_SERVER
-        from character import CharacterVoicevox
-        self._voicevox_path = CharacterVoicevox.DEFAULT_INSTALL_PATH
-        from character import CharacterAIVoice
-        self._aivoice_path = CharacterAIVoice.DEFAULT_INSTALL_PATH
-        self._coeiroink_server = CoeiroinkApi.DEFAULT_SERVER
-        self._coeiroink_path = ""
+        # 設定はスナップショットを差し替えて変更するので、読み出すときはロックしなくてよい
+        self._values = MappingProxyType(Settings._default_values())
+        self._save_timer = None
+        atexit.register(self.flush)
+
+    # 設定の既定値（設定ファイルに保存する順番）
+    @staticmethod
+    def _default_values():
+        return {
+            "assistant_prompt": "ずんだ",
+            "assistant_echo": True,
+            "assistant_tts_software": "VOICEVOX",
+            "assistant_speaker_id": "3",    # ずんだもん
+            "assistant_speed_scale": 1.2,
+            "assistant_pitch_scale": 0.0,
+            "user_prompt": "あなた",
+            "user_echo": True,
+            "user_tts_software": "VOICEVOX",
+            "user_speaker_id": "13",    # 青山龍星
+            "user_speed_scale": 1.2,
+            "user_pitch_scale": 0.0,
+            "chat_api": "OpenAI",
+            "chat_model": "gpt-3.5-turbo-1106",
+            "chat_instruction": "君は優秀なアシスタント。ずんだもんの話し方で話す。具体的には語尾に「のだ」または「なのだ」をつけて自然に話す。回答は１００文字以内で簡潔に行う。",
+            "chat_bad_response": "答えられないのだ",
+            "chat_history_size": 6,
+            "chat_context_tokens": 2000,
+            "chat_log_folder": "log",
+            "chat_log_fsync_interval": 0,
+            "chat_search_index_file": "search_index.db",
+            "chat_log_archive_days": 30,
+            "chat_view_page_size": 10,
+            "chat_summary_enable": False,
+            "chat_summary_threshold": 1000,
+            "chat_summary_model": "",
+            "chat_summary_max_tokens": 300,
+            "chat_response_cache_enable": False,
+            "chat_response_cache_file": "response_cache.db",
+            "chat_response_cache_ttl": 86400,
+            "chat_response_cache_size": 1000,
+            "sentence_min_length": SentenceSegmenter.DEFAULT_MIN_LENGTH,
+            "sentence_max_length": SentenceSegmenter.DEFAULT_MAX_LENGTH,
+            "sentence_first_clause_early": False,
+            "voicevox_server": VoicevoxAPI.DEFAULT_SERVER,
+            "voicevox_batch_concurrency": VoicevoxAPI.DEFAULT_BATCH_CONCURRENCY,
+            "voicevox_path": Settings.DEFAULT_VOICEVOX_PATH,
+            "aivoice_path": Settings.DEFAULT_AIVOICE_PATH,
+            "coeiroink_server": CoeiroinkApi.DEFAULT_SERVER,
+            "coeiroink_path": "",
+            "audio_cache_folder": "cache",
+            "audio_cache_size": 100,
+            "http_pool_size": http_session.DEFAULT_POOL_SIZE,
+            "http_connect_timeout": http_session.DEFAULT_CONNECT_TIMEOUT,
+            "http_read_timeout": http_session.DEFAULT_READ_TIMEOUT,
+            "http_retries": http_session.DEFAULT_RETRIES,
+            "http_backoff_factor": http_session.DEFAULT_BACKOFF_FACTOR,
+            "metrics_file": "",
+            "metrics_window": 1000,
+        }
 
     # プロンプト（アシスタント）
     def get_assistant_prompt(self):
-        with self._lock:
-            return self._assistant_prompt
+        return self._values["assistant_prompt"]
 
     def set_assistant_prompt(self, prompt):
-        with self._lock:
-            self._assistant_prompt = prompt
+        self._set("assistant_prompt", prompt)
 
     # 発話するか（アシスタント）
     def get_assistant_echo_enable(self):
-        with self._lock:
-            return self._assistant_echo
+        return self._values["assistant_echo"]
 
     def set_assistant_echo_enable(self, enable):
-        with self._lock:
-            self._assistant_echo = enable
+        self._set("assistant_echo", enable)
 
     # 使用する読み上げソフト（アシスタント）
     def get_assistant_tts_software(self):
-        with self._lock:
-            return self._assistant_tts_software
+        return self._values["assistant_tts_software"]
 
     def set_assistant_tts_software(self, software):
-        with self._lock:
-            self._assistant_tts_software = software
+        self._set("assistant_tts_software", software)
 
     # 話者ID（アシスタント）
     def get_assistant_speaker_id(self):
-        with self._lock:
-            return self._assistant_speaker_id
+        return self._values["assistant_speaker_id"]
 
     def set_assistant_speaker_id(self, speaker_id):
-        with self._lock:
-            self._assistant_speaker_id = speaker_id
+        self._set("assistant_speaker_id", speaker_id)
 
     # 読み上げスピード（アシスタント）
     def get_assistant_speed_scale(self):
-        with self._lock:
-            return self._assistant_speed_scale
+        return self._values["assistant_speed_scale"]
 
     def set_assistant_speed_scale(self, speed_scale):
-        with self._lock:
-            self._assistant_speed_scale = speed_scale
+        self._set("assistant_speed_scale", speed_scale)
 
     # 声の高さ（アシスタント）
     def get_assistant_pitch_scale(self):
-        with self._lock:
-            return self._assistant_pitch_scale
+        return self._values["assistant_pitch_scale"]
 
     def set_assistant_pitch_scale(self, pitch_scale):
-        with self._lock:
-            self._assistant_pitch_scale = pitch_scale
+        self._set("assistant_pitch_scale", pitch_scale)
 
     # プロンプト（ユーザー）
     def get_user_prompt(self):
-        with self._lock:
-            return self._user_prompt
+        return self._values["user_prompt"]
 
     def set_user_prompt(self, prompt):
-        with self._lock:
-            self._user_prompt = prompt
+        self._set("user_prompt", prompt)
 
     # 発話するか（ユーザー）
     def get_user_echo_enable(self):
-        with self._lock:
-            return self._user_echo
+        return self._values["user_echo"]
 
     def set_user_echo_enable(self, enable):
-        with self._lock:
-            self._user_echo = enable
+        self._set("user_echo", enable)
 
     # 使用する読み上げソフト（ユーザー）
     def get_user_tts_software(self):
-        with self._lock:
-            return self._user_tts_software
+        return self._values["user_tts_software"]
 
     def set_user_tts_software(self, software):
-        with self._lock:
-            self._user_tts_software = software
+        self._set("user_tts_software", software)
 
     # 話者ID（ユーザー）
     def get_user_speaker_id(self):
-        with self._lock:
-            return self._user_speaker_id
+        return self._values["user_speaker_id"]
 
     def set_user_speaker_id(self, speaker_id):
-        with self._lock:
-            self._user_speaker_id = speaker_id
+        self._set("user_speaker_id", speaker_id)
 
     # 読み上げスピード（ユーザー）
     def get_user_speed_scale(self):
-        with self._lock:
-            return self._user_speed_scale
+        return self._values["user_speed_scale"]
 
     def set_user_speed_scale(self, speed_scale):
-        with self._lock:
-            self._user_speed_scale = speed_scale
+        self._set("user_speed_scale", speed_scale)
 
     # 声の高さ（ユーザー）
     def get_user_pitch_scale(self):
-        with self._lock:
-            return self._user_pitch_scale
+        return self._values["user_pitch_scale"]
 
     def set_user_pitch_scale(self, pitch_scale):
-        with self._lock:
-            self._user_pitch_scale = pitch_scale
+        self._set("user_pitch_scale", pitch_scale)
 
     # チャットエージェントのモデル
     def get_chat_api(self):
-        with self._lock:
-            return self._chat_api
+        return self._values["chat_api"]
 
     def set_chat_api(self, chat_api):
-        with self._lock:
-            self._chat_api = chat_api
+        self._set("chat_api", chat_api)
 
     # チャットエージェントのモデル
     def get_chat_model(self):
-        with self._lock:
-            return self._chat_model
+        return self._values["chat_model"]
     
     def set_chat_model(self, chat_model):
-        with self._lock:
-            self._chat_model = chat_model
+        self._set("chat_model", chat_model)
 
     # チャットエージェントへの指示
     def get_chat_instruction(self):
-        with self._lock:
-            return self._chat_instruction
+        return self._values["chat_instruction"]
         
     def set_chat_instruction(self, chat_instruction):
-        with self._lock:
-            self._chat_instruction = chat_instruction
+        self._set("chat_instruction", chat_instruction)
 
     # チャットエージェントが答えられないときの台詞
     def get_chat_bad_response(self):
-        with self._lock:
-            return self._chat_bad_response
+        return self._values["chat_bad_response"]
         
     def set_chat_bad_response(self, chat_bad_response):
-        with self._lock:
-            self._chat_bad_response = chat_bad_response
+        self._set("chat_bad_response", chat_bad_response)
 
     # チャットエージェントに送信する過去会話数
     def get_chat_history_size(self):
-        with self._lock:
-            return min(self._chat_history_size, 50) # 事故防止用 最大50まで
+        return min(self._values["chat_history_size"], 50) # 事故防止用 最大50まで
 
     def set_chat_history_size(self, chat_history_size):
-        with self._lock:
-            self._chat_history_size = chat_history_size
+        self._set("chat_history_size", chat_history_size)
+
+    # チャットエージェントに送信する過去会話のトークン数の上限（0なら会話数で制限する）
+    def get_chat_context_tokens(self):
+        return self._values["chat_context_tokens"]
+
+    def set_chat_context_tokens(self, chat_context_tokens):
+        self._set("chat_context_tokens", chat_context_tokens)
 
     # チャットのログを保存するフォルダ
     def get_chat_log_folder(self):
-        with self._lock:
-            return self._chat_log_folder
+        return self._values["chat_log_folder"]
         
     def set_chat_log_folder(self, chat_log_folder):
-        with self._lock:
-            self._chat_log_folder = chat_log_folder
+        self._set("chat_log_folder", chat_log_folder)
+
+    # チャットのログを何メッセージごとにディスクへ確定させるか（0なら確定させない）
+    def get_chat_log_fsync_interval(self):
+        return self._values["chat_log_fsync_interval"]
+
+    def set_chat_log_fsync_interval(self, interval):
+        self._set("chat_log_fsync_interval", interval)
+
+    # チャットのログを検索するための索引ファイル（空文字なら検索しない）
+    def get_chat_search_index_file(self):
+        return self._values["chat_search_index_file"]
+
+    def set_chat_search_index_file(self, path):
+        self._set("chat_search_index_file", path)
+
+    # 何日より前のチャットのログを書庫にまとめるか（compact_logs.pyで使う）
+    def get_chat_log_archive_days(self):
+        return self._values["chat_log_archive_days"]
+
+    def set_chat_log_archive_days(self, days):
+        self._set("chat_log_archive_days", days)
+
+    # 読み込んだ会話を表示するときの1ページのメッセージ数
+    def get_chat_view_page_size(self):
+        return self._values["chat_view_page_size"]
+
+    def set_chat_view_page_size(self, size):
+        self._set("chat_view_page_size", size)
+
+    # 古い会話を要約して送信するか
+    def get_chat_summary_enable(self):
+        return self._values["chat_summary_enable"]
+
+    def set_chat_summary_enable(self, enable):
+        self._set("chat_summary_enable", enable)
+
+    # 要約されていない古い会話が何トークンを超えたら要約するか
+    def get_chat_summary_threshold(self):
+        return self._values["chat_summary_threshold"]
+
+    def set_chat_summary_threshold(self, threshold):
+        self._set("chat_summary_threshold", threshold)
+
+    # 要約に使うモデル（空文字ならchat_modelと同じモデル）
+    def get_chat_summary_model(self):
+        return self._values["chat_summary_model"]
+
+    def set_chat_summary_model(self, model):
+        self._set("chat_summary_model", model)
+
+    # 要約の最大トークン数
+    def get_chat_summary_max_tokens(self):
+        return self._values["chat_summary_max_tokens"]
+
+    def set_chat_summary_max_tokens(self, max_tokens):
+        self._set("chat_summary_max_tokens", max_tokens)
+
+    # 応答キャッシュを使うかどうか
+    def get_chat_response_cache_enable(self):
+        return self._values["chat_response_cache_enable"]
+
+    def set_chat_response_cache_enable(self, enable):
+        self._set("chat_response_cache_enable", enable)
+
+    # 応答キャッシュのファイル
+    def get_chat_response_cache_file(self):
+        return self._values["chat_response_cache_file"]
+
+    def set_chat_response_cache_file(self, file):
+        self._set("chat_response_cache_file", file)
+
+    # キャッシュした回答を使う期間（秒）
+    def get_chat_response_cache_ttl(self):
+        return self._values["chat_response_cache_ttl"]
+
+    def set_chat_response_cache_ttl(self, ttl):
+        self._set("chat_response_cache_ttl", ttl)
+
+    # キャッシュする回答の最大件数
+    def get_chat_response_cache_size(self):
+        return self._values["chat_response_cache_size"]
+
+    def set_chat_response_cache_size(self, size):
+        self._set("chat_response_cache_size", size)
+
+    # 読み上げる文の最小文字数
+    def get_sentence_min_length(self):
+        return self._values["sentence_min_length"]
+
+    def set_sentence_min_length(self, length):
+        self._set("sentence_min_length", length)
+
+    # 読み上げる文の最大文字数
+    def get_sentence_max_length(self):
+        return self._values["sentence_max_length"]
+
+    def set_sentence_max_length(self, length):
+        self._set("sentence_max_length", length)
+
+    # 応答の最初の文を読点で区切って早めに読み上げるか
+    def get_sentence_first_clause_early(self):
+        return self._values["sentence_first_clause_early"]
+
+    def set_sentence_first_clause_early(self, enable):
+        self._set("sentence_first_clause_early", enable)
 
     # VOICEVOX サーバーのURL
     def get_voicevox_server(self):
-        with self._lock:
-            return self._voicevox_server
+        return self._values["voicevox_server"]
     
     def set_voicevox_server(self, voicevox_server):
-        with self._lock:
-            self._voicevox_server = voicevox_server
+        self._set("voicevox_server", voicevox_server)
+
+    # VOICEVOXでまとめて音声を生成するときの同時リクエスト数
+    def get_voicevox_batch_concurrency(self):
+        return self._values["voicevox_batch_concurrency"]
+
+    def set_voicevox_batch_concurrency(self, concurrency):
+        self._set("voicevox_batch_concurrency", concurrency)
 
     # VOICEVOXインストールパス
     def get_voicevox_path(self):
-        with self._lock:
-            return self._voicevox_path
+        return self._values["voicevox_path"]
         
     def set_voicevox_path(self, path):
-        with self._lock:
-            self._voicevox_path = path
+        self._set("voicevox_path", path)
 
     # A.I.VOICEインストールパス
     def get_aivoice_path(self):
-        with self._lock:
-            return self._aivoice_path
+        return self._values["aivoice_path"]
         
     def set_aivoice_path(self, path):
-        with self._lock:
-            self._aivoice_path = path
+        self._set("aivoice_path", path)
 
     # COEIROINK サーバーのURL
     def get_coeiroink_server(self):
-        with self._lock:
-            return self._coeiroink_server
+        return self._values["coeiroink_server"]
     
     def set_coeiroink_server(self, coeiroink_server):
-        with self._lock:
-            self._coeiroink_server = coeiroink_server
+        self._set("coeiroink_server", coeiroink_server)
 
     # COEIROINKインストールパス
     def get_coeiroink_path(self):
-        with self._lock:
-            return self._coeiroink_path
+        return self._values["coeiroink_path"]
         
     def set_coeiroink_path(self, path):
-        with self._lock:
-            self._coeiroink_path = path
+        self._set("coeiroink_path", path)
+
+    # 合成音声キャッシュを保存するフォルダ
+    def get_audio_cache_folder(self):
+        return self._values["audio_cache_folder"]
+
+    def set_audio_cache_folder(self, folder):
+        self._set("audio_cache_folder", folder)
+
+    # 合成音声キャッシュの最大サイズ（MB）
+    def get_audio_cache_size(self):
+        return self._values["audio_cache_size"]
+
+    def set_audio_cache_size(self, size):
+        self._set("audio_cache_size", size)
+
+    # 音声合成エンジンとのHTTP接続プールのサイズ
+    def get_http_pool_size(self):
+        return self._values["http_pool_size"]
+
+    def set_http_pool_size(self, pool_size):
+        self._set("http_pool_size", pool_size)
+
+    # 音声合成エンジンへの接続タイムアウト（秒）
+    def get_http_connect_timeout(self):
+        return self._values["http_connect_timeout"]
+
+    def set_http_connect_timeout(self, timeout):
+        self._set("http_connect_timeout", timeout)
+
+    # 音声合成エンジンからの読み込みタイムアウト（秒）
+    def get_http_read_timeout(self):
+        return self._values["http_read_timeout"]
+
+    def set_http_read_timeout(self, timeout):
+        self._set("http_read_timeout", timeout)
+
+    # 音声合成エンジンへのリクエストの再試行回数
+    def get_http_retries(self):
+        return self._values["http_retries"]
+
+    def set_http_retries(self, retries):
+        self._set("http_retries", retries)
+
+    # 再試行の待ち時間の係数
+    def get_http_backoff_factor(self):
+        return self._values["http_backoff_factor"]
+
+    def set_http_backoff_factor(self, backoff_factor):
+        self._set("http_backoff_factor", backoff_factor)
+
+    # 終了するときに計測結果を追記するファイル（空文字なら保存しない）
+    def get_metrics_file(self):
+        return self._values["metrics_file"]
+
+    def set_metrics_file(self, path):
+        self._set("metrics_file", path)
+
+    # 計測値を名前ごとに直近いくつまで集計するか
+    def get_metrics_window(self):
+        return self._values["metrics_window"]
+
+    def set_metrics_window(self, window):
+        self._set("metrics_window", window)
 
     # 設定ファイルを保存する
+    # 続けて変更されたときに1回の書き込みで済むように、少し待ってから最新の設定をまとめて書き込む
     def save(self):
         with self._lock:
-            self._save_nolock()
-
-    def _save_nolock(self):
-        with open(self._setting_file_path, "w", encoding="utf-8") as file:
-            setting = {}
-            setting["file_ver"] = Settings.FILE_VER
-            setting["assistant_prompt"] = self._assistant_prompt
-            setting["assistant_echo"] = self._assistant_echo
-            setting["assistant_tts_software"] = self._assistant_tts_software
-            setting["assistant_speaker_id"] = self._assistant_speaker_id
-            setting["assistant_speed_scale"] = self._assistant_speed_scale
-            setting["assistant_pitch_scale"] = self._assistant_pitch_scale
-            setting["user_prompt"] = self._user_prompt
-            setting["user_echo"] = self._user_echo
-            setting["user_tts_software"] = self._user_tts_software
-            setting["user_speaker_id"] = self._user_speaker_id
-            setting["user_speed_scale"] = self._user_speed_scale
-            setting["user_pitch_scale"] = self._user_pitch_scale
-            setting["chat_api"] = self._chat_api
-            setting["chat_model"] = self._chat_model
-            setting["chat_instruction"] = self._chat_instruction
-            setting["chat_bad_response"] = self._chat_bad_response
-            setting["chat_history_size"] = self._chat_history_size
-            setting["chat_log_folder"] = self._chat_log_folder
-            setting["voicevox_server"] = self._voicevox_server
-            setting["voicevox_path"] = self._voicevox_path
-            setting["aivoice_path"] = self._aivoice_path
-            setting["coeiroink_server"] = self._coeiroink_server
-            setting["coeiroink_path"] = self._coeiroink_path
-            json.dump(setting, file, ensure_ascii=False, indent=4)
+            if self._save_timer is not None:
+                return
+            self._save_timer = threading.Timer(Settings.SAVE_DELAY, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    # 書き込み待ちの設定があれば、すぐに設定ファイルに書き込む
+    def flush(self):
+        with self._lock:
+            if self._save_timer is None:
+                return
+            self._save_timer.cancel()
+            self._save_timer = None
+            self._write(self._values)
 
     # 設定ファイルを読み込む
     def load(self):
         if not os.path.exists(self._setting_file_path):
-            self._init_member()
-            self._save_nolock()
+            with self._lock:
+                self._values = MappingProxyType(Settings._default_values())
+                self._write(self._values)
             return
 
+        with open(self._setting_file_path, "r", encoding="utf-8") as file:
+            setting = json.load(file)
+        file_ver = setting.get("file_ver", 1)
+
+        values = Settings._default_values()
+        for key in values:
+            values[key] = setting.get(key, values[key])
+
         with self._lock:
-            with open(self._setting_file_path, "r", encoding="utf-8") as file:
-                setting = json.load(file)
-                file_ver = setting.get("file_ver", 1)
-                self._assistant_prompt = setting.get("assistant_prompt", self._assistant_prompt)
-                self._assistant_echo = setting.get("assistant_echo", self._assistant_echo)
-                self._assistant_tts_software = setting.get("assistant_tts_software", self._assistant_tts_software)
-                self._assistant_speaker_id = setting.get("assistant_speaker_id", self._assistant_speaker_id)
-                self._assistant_speed_scale = setting.get("assistant_speed_scale", self._assistant_speed_scale)
-                self._assistant_pitch_scale = setting.get("assistant_pitch_scale", self._assistant_pitch_scale)
-                self._user_prompt = setting.get("user_prompt", self._user_prompt)
-                self._user_echo = setting.get("user_echo", self._user_echo)
-                self._user_tts_software = setting.get("user_tts_software", self._user_tts_software)
-                self._user_speaker_id = setting.get("user_speaker_id", self._user_speaker_id)
-                self._user_speed_scale = setting.get("user_speed_scale", self._user_speed_scale)
-                self._user_pitch_scale = setting.get("user_pitch_scale", self._user_pitch_scale)
-                self._chat_api = setting.get("chat_api", self._chat_api)
-                self._chat_model = setting.get("chat_model", self._chat_model)
-                self._chat_instruction = setting.get("chat_instruction", self._chat_instruction)
-                self._chat_bad_response = setting.get("chat_bad_response", self._chat_bad_response)
-                self._chat_history_size = setting.get("chat_history_size", self._chat_history_size)
-                self._chat_log_folder = setting.get("chat_log_folder", self._chat_log_folder)
-                self._voicevox_server = setting.get("voicevox_server", self._voicevox_server)
-                self._voicevox_path = setting.get("voicevox_path", self._voicevox_path)
-                self._aivoice_path = setting.get("aivoice_path", self._aivoice_path)
-                self._coeiroink_server = setting.get("coeiroink_server", self._coeiroink_server)
-                self._coeiroink_path = setting.get("coeiroink_path", self._coeiroink_path)
-
-        if file_ver < Settings.FILE_VER:
-            self._save_nolock()
+            self._values = MappingProxyType(values)
+            if file_ver < Settings.FILE_VER:
+                self._write(self._values)
 
         return setting
+
+    # 現在の設定のスナップショット（変更できない設定名→値の辞書）を取得する
+    # 設定が変更されても取得したスナップショットは変わらないので、複数の設定を組み合わせて使うときに使う
+    def snapshot(self):
+        return self._values
+
+    # 設定を変更する（変更した設定で新しいスナップショットを作って差し替える）
+    def _set(self, key, value):
+        with self._lock:
+            values = dict(self._values)
+            values[key] = value
+            self._values = MappingProxyType(values)
+
+    # 設定ファイルに書き込む
+    # 書き込み中に止まっても設定ファイルが壊れないように、一時ファイルに書いてから置き換える
+    def _write(self, values):
+        setting = {"file_ver": Settings.FILE_VER}
+        setting.update(values)
+        temp_path = self._setting_file_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(setting, file, ensure_ascii=False, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self._setting_file_path)
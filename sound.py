@@ -6,31 +6,230 @@
 # このソースコードは MITライセンス の下でライセンスされています。
 # ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
 
-import io
-import wave
+import atexit
+import queue
+import struct
+import threading
 
-import pyaudio
+import metrics
 
-# 音声データを再生する
-def play_sound(wave_data):
-    wave_file = wave.open(io.BytesIO(wave_data), 'rb')
-    audio = pyaudio.PyAudio()
+# WAVEデータの逐次解析クラス
+# 受信途中のWAVEデータを少しずつ受け取り、ヘッダーを解析しながら再生できるフレームを取り出す
+class WaveStreamParser:
+    WAVE_FORMAT_PCM = 1
+
+    def __init__(self):
+        # (サンプル幅, チャンネル数, サンプリングレート)
+        self.format = None
+        self._buffer = bytearray()
+        self._header_parsed = False
+        self._skip_size = 0
+        self._block_align = 1
+        self._data_remaining = None
+
+    # 受信したデータを追加して、再生できるフレームを返す
+    def feed(self, chunk: bytes) -> bytes:
+        self._buffer.extend(chunk)
+
+        if self._data_remaining is None:
+            if not self._parse_header():
+                return b""
+
+        size = min(len(self._buffer), self._data_remaining)
+        size -= size % self._block_align
+        frames = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._data_remaining -= size
+        return frames
+
+    # dataチャンクの手前までヘッダーを解析する（解析し終わったらTrueを返す）
+    def _parse_header(self):
+        if not self._header_parsed:
+            if len(self._buffer) < 12:
+                return False
+            riff, _, wave_id = struct.unpack("<4sI4s", self._buffer[:12])
+            if riff != b"RIFF" or wave_id != b"WAVE":
+                raise ValueError("WAVEデータではありません")
+            del self._buffer[:12]
+            self._header_parsed = True
+
+        while True:
+            if self._skip_size > 0:
+                size = min(self._skip_size, len(self._buffer))
+                del self._buffer[:size]
+                self._skip_size -= size
+                if self._skip_size > 0:
+                    return False
+
+            if len(self._buffer) < 8:
+                return False
+            chunk_id, chunk_size = struct.unpack("<4sI", self._buffer[:8])
+
+            if chunk_id == b"data":
+                if self.format is None:
+                    raise ValueError("fmtチャンクがありません")
+                del self._buffer[:8]
+                self._data_remaining = chunk_size
+                return True
+
+            if chunk_id == b"fmt ":
+                if len(self._buffer) < 8 + chunk_size:
+                    return False
+                audio_format, channels, rate, _, block_align, bits = struct.unpack("<HHIIHH", self._buffer[8:24])
+                if audio_format != WaveStreamParser.WAVE_FORMAT_PCM:
+                    raise ValueError(f"対応していないWAVEフォーマットです: {audio_format}")
+                self.format = (bits // 8, channels, rate)
+                self._block_align = block_align
+
+            del self._buffer[:8]
+            self._skip_size = chunk_size + (chunk_size % 2)
+
+# 音声再生クラス
+# PyAudioと出力ストリームを開いたまま保持して、文をまたいで使い回す
+class AudioPlayer:
+    CHUNK_FRAMES = 1024
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self._audio = None
+        self._stream = None
+        self._stream_format = None
+        self._closed = False
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    # 共有のプレーヤーを取得する
+    @classmethod
+    def get_instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = AudioPlayer()
+                atexit.register(cls._instance.close)
+            return cls._instance
+
+    # 音声データを再生キューに追加する（再生が終わるとイベントがセットされる）
+    # wave_dataにはWAVEデータ全体か、受信途中のWAVEデータのチャンクを返すイテレータを渡す
+    def enqueue(self, wave_data) -> threading.Event:
+        done = threading.Event()
+        self._queue.put((wave_data, done, self._generation))
+        return done
 
-    try:
-        format = audio.get_format_from_width(wave_file.getsampwidth())
+    # 音声データを再生して、再生が終わるまで待つ
+    def play(self, wave_data):
+        self.enqueue(wave_data).wait()
 
-        stream = audio.open(
-            format=format,
-            channels=wave_file.getnchannels(),
-            rate=wave_file.getframerate(),
+    # 再生キューが空になるまで待つ
+    def wait(self):
+        self._queue.join()
+
+    # 再生中の音声を止めて、再生キューに追加された音声を破棄する
+    def cancel(self):
+        with self._lock:
+            self._generation += 1
+
+    # PyAudioを初期化しておき、最初の再生で待たないようにする
+    def warm_up(self):
+        with self._lock:
+            if not self._closed:
+                self._init_audio()
+
+    # 出力ストリームとPyAudioを閉じる
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._close_stream()
+            if self._audio is not None:
+                self._audio.terminate()
+                self._audio = None
+
+    # 再生スレッド
+    def _worker(self):
+        while True:
+            wave_data, done, generation = self._queue.get()
+            try:
+                self._write(wave_data, generation)
+            except Exception:
+                with self._lock:
+                    self._close_stream()
+            finally:
+                done.set()
+                self._queue.task_done()
+
+    # 音声データを出力ストリームに書き込む
+    def _write(self, wave_data, generation):
+        chunks = [wave_data] if isinstance(wave_data, (bytes, bytearray)) else wave_data
+        parser = WaveStreamParser()
+        try:
+            for chunk in chunks:
+                frames = parser.feed(chunk)
+                if len(frames) == 0:
+                    continue
+
+                write_size = self._get_write_size(parser.format)
+                for offset in range(0, len(frames), write_size):
+                    with self._lock:
+                        if self._closed or generation != self._generation:
+                            return
+                        stream = self._open_stream(parser.format)
+                        stream.write(frames[offset:offset + write_size])
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    # 一度に書き込むバイト数を取得する
+    def _get_write_size(self, stream_format):
+        sampwidth, channels, _ = stream_format
+        return AudioPlayer.CHUNK_FRAMES * sampwidth * channels
+
+    # 出力ストリームを開く（フォーマットが変わったときだけ開きなおす）
+    def _open_stream(self, stream_format):
+        if self._stream is not None and self._stream_format == stream_format:
+            return self._stream
+
+        self._close_stream()
+        self._init_audio()
+
+        sampwidth, channels, rate = stream_format
+        self._stream = self._audio.open(
+            format=self._audio.get_format_from_width(sampwidth),
+            channels=channels,
+            rate=rate,
             output=True)
+        self._stream_format = stream_format
+        return self._stream
+
+    # PyAudioを初期化する
+    # PyAudioは起動を遅くするので、最初に使うときに読み込む
+    def _init_audio(self):
+        if self._audio is None:
+            import pyaudio
+
+            self._audio = pyaudio.PyAudio()
+
+    # 出力ストリームを閉じる
+    def _close_stream(self):
+        if self._stream is not None:
+            try:
+                self._stream.stop_stream()
+                self._stream.close()
+            finally:
+                self._stream = None
+                self._stream_format = None
+
+# 音声データを再生する（WAVEデータ全体か、WAVEデータのチャンクを返すイテレータを渡す）
+def play_sound(wave_data):
+    with metrics.timer("audio.playback"):
+        AudioPlayer.get_instance().play(wave_data)
+
+# 再生の準備をしておく
+def warm_up_sound():
+    AudioPlayer.get_instance().warm_up()
 
-        data = wave_file.readframes(1024)
-        while data != b'':
-            stream.write(data)
-            data = wave_file.readframes(1024)
-    finally:
-        stream.stop_stream()
-        stream.close()
-        audio.terminate()
-        wave_file.close()
+# 再生中の音声を止める
+def stop_sound():
+    AudioPlayer.get_instance().cancel()
@@ -0,0 +1,81 @@
+# ZundaGPT
+#
+# 音声合成エンジン登録モジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+import threading
+from typing import Callable
+
+from engine_monitor import EngineMonitor
+
+# 音声合成エンジンクラス
+# 同じエンジンを使うキャラクターで、エンジンの監視、バージョン、話者ごとの準備の状態を共有する
+# キャラクターを作りなおしたり声を変えたりしても、エンジンの起動や確認をやりなおさずに済む
+class SpeechEngine:
+    _engines = {}
+    _engines_lock = threading.Lock()
+
+    def __init__(self, monitor: EngineMonitor, startup_timeout: float,
+                 warm_up: Callable[[str], None] = None, get_version: Callable[[], str] = None):
+        # warm_upは話者の準備のために短い文を合成する関数、get_versionはエンジンのバージョンを取得する関数
+        self.monitor = monitor
+        self.startup_timeout = startup_timeout
+        self._warm_up = warm_up
+        self._get_version = get_version
+        self._version = None
+        self._version_start_count = None
+        self._prepared = {}
+        self._lock = threading.Lock()
+
+    # 登録されたエンジンを取得する（なければfactoryで作成して登録する）
+    @classmethod
+    def get(cls, name: str, factory: Callable[[], "SpeechEngine"]) -> "SpeechEngine":
+        with cls._engines_lock:
+            engine = cls._engines.get(name)
+            if engine is None:
+                engine = factory()
+                cls._engines[name] = engine
+            return engine
+
+    # 話者の準備を始めて、準備が終わるとセットされるイベントを返す（準備済みか準備中の話者ならそのイベントを返す）
+    # エンジンの起動を待ってから短い文を合成して、最初の読み上げで話者の読み込みを待たないようにする
+    def prepare(self, speaker_id: str) -> threading.Event:
+        with self._lock:
+            ready = self._prepared.get(speaker_id)
+            if ready is None:
+                ready = threading.Event()
+                self._prepared[speaker_id] = ready
+                threading.Thread(target=self._prepare_worker, args=(speaker_id, ready), daemon=True).start()
+            return ready
+
+    # エンジンのバージョンを取得する（取得できなければNone）
+    # エンジンが再起動したら、更新されているかもしれないので取得しなおす
+    def get_version(self):
+        start_count = self.monitor.start_count
+        if self._version_start_count != start_count:
+            self._version = None
+            self._version_start_count = start_count
+        if self._version is None and self._get_version is not None:
+            self._version = self._get_version()
+        return self._version
+
+    # 話者の準備スレッド（準備が終わる、または起動しなければタイムアウトするとイベントをセットする）
+    # 準備できなかった話者は、次にその話者を使うときに準備しなおす
+    def _prepare_worker(self, speaker_id, ready):
+        prepared = False
+        try:
+            if self.monitor.wait_until_up(self.startup_timeout):
+                if self._warm_up is not None:
+                    self._warm_up(speaker_id)
+                prepared = True
+        except Exception:
+            pass
+        finally:
+            if not prepared:
+                with self._lock:
+                    if self._prepared.get(speaker_id) is ready:
+                        del self._prepared[speaker_id]
+            ready.set()
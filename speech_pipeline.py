@@ -0,0 +1,110 @@
+# ZundaGPT
+#
+# 音声読み上げパイプラインモジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+import queue
+import threading
+import time
+
+import metrics
+
+# 音声読み上げパイプライン
+# 合成スレッドが次の文を先に合成しておき、再生スレッドが順番に再生する
+class SpeechPipeline:
+    # 合成済みで再生待ちにしておける文の数
+    PREFETCH_SIZE = 4
+
+    def __init__(self):
+        self._synthesis_queue = queue.Queue()
+        self._playback_queue = queue.Queue(maxsize=SpeechPipeline.PREFETCH_SIZE)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._playing_character = None
+
+        self._synthesis_thread = threading.Thread(target=self._synthesis_worker, daemon=True)
+        self._playback_thread = threading.Thread(target=self._playback_worker, daemon=True)
+        self._synthesis_thread.start()
+        self._playback_thread.start()
+
+    # 読み上げる文をキューに追加する
+    # replyがTrueならチャットの回答の文として、ターンの計測（turn.first_audioなど）に含める
+    def enqueue(self, character, text, reply=False):
+        self._synthesis_queue.put((character, text, self._generation, time.perf_counter(), reply))
+
+    # キューに追加された文をすべて読み上げ終わるまで待つ
+    def wait(self):
+        self._synthesis_queue.join()
+        self._playback_queue.join()
+
+    # キューに追加された文を破棄して、再生中の音声を止める
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            SpeechPipeline._drain(self._synthesis_queue)
+            for _, data, _, _ in SpeechPipeline._drain(self._playback_queue):
+                SpeechPipeline._close_data(data)
+            character = self._playing_character
+
+        if character is not None:
+            character.stop()
+
+    # キューを空にして、取り出した要素を返す
+    @staticmethod
+    def _drain(target_queue):
+        items = []
+        while True:
+            try:
+                items.append(target_queue.get_nowait())
+            except queue.Empty:
+                return items
+            target_queue.task_done()
+
+    # 受信途中の音声データなら通信を閉じる
+    @staticmethod
+    def _close_data(data):
+        if hasattr(data, "close"):
+            data.close()
+
+    # 音声合成スレッド
+    # 再生待ちの文がなければ、受信しながら再生できるようにストリーミングで合成する
+    def _synthesis_worker(self):
+        while True:
+            character, text, generation, enqueued_at, reply = self._synthesis_queue.get()
+            try:
+                if generation != self._generation:
+                    continue
+                prefix = "speech" if reply else "speech.echo"
+                metrics.record(f"{prefix}.queue_wait", (time.perf_counter() - enqueued_at) * 1000)
+                stream = self._playback_queue.unfinished_tasks == 0
+                with metrics.timer(f"{prefix}.synthesis"):
+                    data = character.synthesize(text, stream=stream)
+                if data is not None:
+                    self._playback_queue.put((character, data, generation, reply))
+            except Exception:
+                pass
+            finally:
+                self._synthesis_queue.task_done()
+
+    # 音声再生スレッド
+    def _playback_worker(self):
+        while True:
+            character, data, generation, reply = self._playback_queue.get()
+            try:
+                with self._lock:
+                    if generation != self._generation:
+                        SpeechPipeline._close_data(data)
+                        continue
+                    self._playing_character = character
+                if reply:
+                    metrics.mark_turn("turn.first_audio")
+                character.play(data)
+            except Exception:
+                pass
+            finally:
+                with self._lock:
+                    self._playing_character = None
+                self._playback_queue.task_done()
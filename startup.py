@@ -0,0 +1,35 @@
+# ZundaGPT
+#
+# 起動処理モジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+# 起動処理クラス
+# チャットの作成や音声合成エンジンの起動など、互いに関係のない起動時の処理を並行して行う
+# 必要になった処理の結果だけを待つので、残りの処理はバックグラウンドで続けられる
+class StartupOrchestrator:
+    # 並行して行う処理の最大数
+    MAX_WORKERS = 4
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(StartupOrchestrator.MAX_WORKERS, thread_name_prefix="Startup")
+        self._futures = {}
+
+    # 処理を開始する
+    def start(self, name: str, func: Callable, *args) -> Future:
+        future = self._executor.submit(func, *args)
+        self._futures[name] = future
+        return future
+
+    # 処理が終わるまで待って、結果を返す（処理で発生した例外はここで発生する）
+    def result(self, name: str):
+        return self._futures[name].result()
+
+    # 処理を受け付けるのを終える（開始した処理は最後まで続ける）
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
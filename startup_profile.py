@@ -0,0 +1,92 @@
+# ZundaGPT
+#
+# 起動時間計測モジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+#
+# --startup-profile を付けて起動したときに、モジュールのインポートと初期化の処理にかかった時間を計測する
+# インポートを計測するため、ほかのモジュールより先にインポートすること
+
+import builtins
+import contextlib
+import sys
+import threading
+import time
+import unicodedata
+
+# 起動時間を計測するかどうか
+ENABLED = "--startup-profile" in sys.argv
+
+# 表示するインポートの最小時間（ミリ秒）
+MIN_REPORT_MS = 1.0
+
+_start_time = time.perf_counter()
+_original_import = builtins.__import__
+_main_thread = threading.main_thread()
+# (モジュール名, 子のインポートを含む時間, 子のインポートを除く時間, 入れ子の深さ)
+_imports = []
+# 計測中のインポートごとの、子のインポートにかかった時間
+_import_stack = []
+# (処理名, 時間)
+_sections = []
+
+# 時間を計測しながらモジュールをインポートする（メインスレッドで初めてインポートするモジュールだけ計測する）
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level != 0 or name in sys.modules or threading.current_thread() is not _main_thread:
+        return _original_import(name, globals, locals, fromlist, level)
+
+    _import_stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - start
+        children = _import_stack.pop()
+        if _import_stack:
+            _import_stack[-1] += elapsed
+        _imports.append((name, elapsed, elapsed - children, len(_import_stack)))
+
+if ENABLED:
+    builtins.__import__ = _timed_import
+
+# 初期化の処理にかかった時間を計測する
+@contextlib.contextmanager
+def section(name: str):
+    if not ENABLED:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _sections.append((name, time.perf_counter() - start))
+
+# 計測結果を表示する
+# インポートは直接インポートしたモジュールごとに、そのモジュールがインポートしたモジュールの時間も含めて表示する
+# 初期化の処理の時間には、その処理の中で読み込んだモジュールのインポートの時間も含まれる
+def print_report():
+    total = time.perf_counter() - _start_time
+    builtins.__import__ = _original_import
+
+    print("起動時間の内訳（ミリ秒）")
+    print()
+    print("[インポート]")
+    imports = sorted((entry for entry in _imports if entry[3] == 0), key=lambda entry: entry[1], reverse=True)
+    for name, elapsed, self_time, _ in imports:
+        if elapsed * 1000 >= MIN_REPORT_MS:
+            print(f"  {_pad(name, 32)} {elapsed * 1000:9.1f}  （モジュール自身 {self_time * 1000:.1f}）")
+    print(f"  {_pad('合計', 32)} {sum(entry[1] for entry in imports) * 1000:9.1f}")
+    print()
+    print("[初期化]")
+    for name, elapsed in _sections:
+        print(f"  {_pad(name, 32)} {elapsed * 1000:9.1f}")
+    print()
+    print(f"起動にかかった時間 : {total * 1000:.1f}")
+
+# 全角文字を2文字分として、表示幅がwidthになるまで空白を追加する
+def _pad(text: str, width: int) -> str:
+    text_width = sum(2 if unicodedata.east_asian_width(char) in "WF" else 1 for char in text)
+    return text + " " * max(width - text_width, 0)
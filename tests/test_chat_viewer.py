@@ -0,0 +1,73 @@
+# ZundaGPT
+#
+# チャット表示モジュールのテスト
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+import contextlib
+import io
+import unittest
+
+from chat_viewer import ChatViewer
+
+# 表示したメッセージを記録するチャット表示を作成する
+def create_viewer(page_size, shown):
+    return ChatViewer(page_size, lambda: shown.clear(), lambda message: shown.append(message["content"]))
+
+# 会話を作成する（内容は m0, m1, ...）
+def create_messages(count):
+    return [{"role": "user", "content": f"m{index}"} for index in range(count)]
+
+class ChatViewerTest(unittest.TestCase):
+    # 読み込んでいない会話でも、最新のページからさかのぼって表示できる
+    def test_page_live_chat_never_loaded(self):
+        shown = []
+        viewer = create_viewer(10, shown)
+        messages = create_messages(30)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertFalse(viewer.show_newer(messages))
+            self.assertTrue(viewer.show_older(messages))
+            self.assertEqual(shown, [f"m{index}" for index in range(10, 20)])
+            self.assertTrue(viewer.show_older(messages))
+            self.assertEqual(shown, [f"m{index}" for index in range(0, 10)])
+            self.assertFalse(viewer.show_older(messages))
+            self.assertTrue(viewer.show_newer(messages))
+            self.assertEqual(shown, [f"m{index}" for index in range(10, 20)])
+            self.assertTrue(viewer.show_newer(messages))
+            self.assertEqual(shown, [f"m{index}" for index in range(20, 30)])
+            self.assertFalse(viewer.show_newer(messages))
+
+    # 最新のページを表示したあとに会話が続いても、最新のページからさかのぼる
+    def test_older_after_chat_continues(self):
+        shown = []
+        viewer = create_viewer(10, shown)
+        messages = create_messages(12)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            viewer.show_latest(messages)
+            messages.extend(create_messages(10))
+            self.assertTrue(viewer.show_older(messages))
+            self.assertEqual(shown, [message["content"] for message in messages[2:12]])
+
+    # 会話を読み込みなおすと、表示位置が最新のページに戻る
+    def test_show_latest_resets_position(self):
+        shown = []
+        viewer = create_viewer(10, shown)
+        messages = create_messages(30)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            viewer.show_older(messages)
+            loaded = create_messages(25)
+            viewer.show_latest(loaded)
+            self.assertEqual(shown, [f"m{index}" for index in range(15, 25)])
+            self.assertFalse(viewer.show_newer(loaded))
+
+    # 1ページのメッセージの数が1より小さければ1にする
+    def test_page_size_clamped(self):
+        self.assertEqual(create_viewer(0, []).page_size, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+# ZundaGPT
+#
+# トークン数計算モジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# トークン数計算クラス
+# tiktokenがインストールされていればそれを使い、なければ文字の種類からおおよそのトークン数を見積もる
+class TokenCounter:
+    # メッセージごとに加わるトークン数（ロールや区切りの分）
+    TOKENS_PER_MESSAGE = 4
+    # 回答の開始に使われるトークン数
+    TOKENS_PER_REPLY = 3
+    # tiktokenがモデルを知らないときに使うエンコーディング
+    DEFAULT_ENCODING = "cl100k_base"
+
+    def __init__(self, model: str):
+        self.model = model
+        self._encoding = TokenCounter._get_encoding(model)
+
+    # テキストのトークン数を取得する
+    def count_text(self, text: str) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode(text))
+        return TokenCounter._estimate(text)
+
+    # メッセージのトークン数を取得する
+    def count_message(self, message) -> int:
+        return TokenCounter.TOKENS_PER_MESSAGE + self.count_text(message["role"]) + self.count_text(message["content"])
+
+    # モデルに対応するエンコーディングを取得する（使えなければNone）
+    @staticmethod
+    def _get_encoding(model: str):
+        if tiktoken is None:
+            return None
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            pass
+        except Exception:
+            return None
+        try:
+            return tiktoken.get_encoding(TokenCounter.DEFAULT_ENCODING)
+        except Exception:
+            return None
+
+    # おおよそのトークン数を見積もる
+    # 日本語などの非ASCII文字は1文字1トークン、ASCII文字は4文字で1トークンとして数える
+    @staticmethod
+    def _estimate(text: str) -> int:
+        ascii_count = 0
+        other_count = 0
+        for char in text:
+            if ord(char) < 128:
+                ascii_count += 1
+            else:
+                other_count += 1
+        return other_count + (ascii_count + 3) // 4
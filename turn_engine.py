@@ -0,0 +1,132 @@
+# ZundaGPT
+#
+# 対話ターン実行モジュール
+#
+# Copyright (c) 2024 led-mirage
+# このソースコードは MITライセンス の下でライセンスされています。
+# ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
+
+import asyncio
+import signal
+import sys
+import threading
+from typing import Awaitable, Callable, Optional
+
+# 対話ターン実行クラス
+# 入力の受付と、応答の受信・読み上げ（ターン）を別々のタスクで動かし、
+# 応答中に次の入力やCtrl+Cがあれば、実行中のターンだけを中断する
+class TurnEngine:
+    def __init__(self, get_prompt: Callable[[], str], handle_input: Callable[[str], Optional[Awaitable]], cancel_turn: Callable[[], None]):
+        # get_promptは入力プロンプトを返す関数
+        # handle_inputは入力を処理して、実行するターンのコルーチン（なければNone）を返す関数
+        # cancel_turnはターンを中断するときに読み上げなどを止める関数
+        self._get_prompt = get_prompt
+        self._handle_input = handle_input
+        self._cancel_turn = cancel_turn
+        self._loop = None
+        self._inputs = None
+        self._turn = None
+        self._turn_coroutine = None
+        self._barge_in = False
+        self._interrupted = False
+
+    # 入力が終わるまでターンを実行する（待機中にCtrl+Cが押されたらKeyboardInterruptを送出する）
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._inputs = asyncio.Queue()
+        threading.Thread(target=self._read_input, daemon=True).start()
+        previous_handler = signal.signal(signal.SIGINT, self._on_interrupt)
+        try:
+            self._show_prompt()
+            while True:
+                line = await self._inputs.get()
+                if line is None:
+                    await self._wait_turn()
+                    break
+                if line == "":
+                    if self._turn is None:
+                        self._show_prompt()
+                    continue
+
+                await self._cancel(barge_in=True)
+                turn = self._handle_input(line)
+                if turn is None:
+                    self._show_prompt()
+                else:
+                    self._turn_coroutine = turn
+                    self._turn = asyncio.create_task(self._run_turn(turn))
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+            await self._cancel(barge_in=True)
+
+        if self._interrupted:
+            raise KeyboardInterrupt()
+
+    # ターンを実行して、終わったら次の入力プロンプトを表示する
+    async def _run_turn(self, turn: Awaitable):
+        try:
+            await turn
+        except asyncio.CancelledError:
+            print()
+            print("（中断したのだ）")
+            if self._barge_in:
+                raise
+            print()
+        finally:
+            if self._turn is asyncio.current_task():
+                self._turn = None
+        self._show_prompt()
+
+    # 実行中のターンが終わるまで待つ
+    async def _wait_turn(self):
+        turn = self._turn
+        if turn is not None and not self._interrupted:
+            try:
+                await turn
+            except asyncio.CancelledError:
+                pass
+
+    # 実行中のターンを中断して、終わるまで待つ
+    async def _cancel(self, barge_in: bool):
+        turn = self._turn
+        if turn is None or turn.done():
+            return
+
+        self._barge_in = barge_in
+        self._cancel_turn()
+        turn.cancel()
+        try:
+            await turn
+        except asyncio.CancelledError:
+            pass
+        finally:
+            # 開始前に中断されたターンのコルーチンも閉じておく
+            self._turn_coroutine.close()
+            self._barge_in = False
+            self._turn = None
+
+    # 入力プロンプトを表示する
+    def _show_prompt(self):
+        print(self._get_prompt(), end="", flush=True)
+
+    # 標準入力を読み込むスレッド（入力が終わったらNoneを送る）
+    def _read_input(self):
+        while True:
+            line = sys.stdin.readline()
+            if line == "":
+                self._loop.call_soon_threadsafe(self._inputs.put_nowait, None)
+                return
+            self._loop.call_soon_threadsafe(self._inputs.put_nowait, line.rstrip("\r\n"))
+
+    # Ctrl+Cのシグナルハンドラ（イベントループの処理が一区切りついてから処理する）
+    def _on_interrupt(self, signum, frame):
+        self._loop.call_soon_threadsafe(self._interrupt)
+
+    # 応答中ならターンを中断し、入力待ちなら終了する
+    def _interrupt(self):
+        if self._turn is not None and not self._turn.done():
+            self._cancel_turn()
+            self._turn.cancel()
+        else:
+            self._interrupted = True
+            self._inputs.put_nowait(None)
@@ -6,31 +6,45 @@
 # このソースコードは MITライセンス の下でライセンスされています。
 # ライセンスの詳細については、このプロジェクトのLICENSEファイルを参照してください。
 
+import io
 import json
-import requests
+import wave
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
+import http_session
+import metrics
 from voicevox_speaker import VoicevoxSpeaker
 
 class VoicevoxAPI:
     DEFAULT_SERVER = "http://127.0.0.1:50021"
+    DEFAULT_BATCH_CONCURRENCY = 2
+    # ストリーミング受信するときのチャンクサイズ
+    STREAM_CHUNK_SIZE = 8192
+
     server = DEFAULT_SERVER
+    session = http_session.create_session()
+    timeout = (http_session.DEFAULT_CONNECT_TIMEOUT, http_session.DEFAULT_READ_TIMEOUT)
+    # まとめて音声を生成するときに同時に送るリクエストの最大数
+    batch_concurrency = DEFAULT_BATCH_CONCURRENCY
 
     # バージョンを取得する
     @staticmethod
-    def get_version():
+    def get_version(print_error=True):
         try:
-            response = requests.get(f"{VoicevoxAPI.server}/version")
+            response = VoicevoxAPI.session.get(f"{VoicevoxAPI.server}/version", timeout=VoicevoxAPI.timeout)
             response.raise_for_status()
             return response.json()
         except Exception as err:
-            print(err)
+            if print_error:
+                print(err)
             return None
 
     # 話者リストを取得する
     @staticmethod
     def get_speakers():
         try:
-            response = requests.get(f"{VoicevoxAPI.server}/speakers")
+            response = VoicevoxAPI.session.get(f"{VoicevoxAPI.server}/speakers", timeout=VoicevoxAPI.timeout)
             response.raise_for_status()
             items = response.json()
             speakers = []
@@ -47,14 +61,71 @@ class VoicevoxAPI:
     @staticmethod
     def audio_query(text, speaker_id):
         post_params = {"text": text, "speaker": speaker_id}
-        response = requests.post(f"{VoicevoxAPI.server}/audio_query", params=post_params)
+        with metrics.timer("voicevox.audio_query"):
+            response = VoicevoxAPI.session.post(f"{VoicevoxAPI.server}/audio_query", params=post_params, timeout=VoicevoxAPI.timeout)
         response.raise_for_status()
         return response.json()
 
     # 音声データを生成する
+    # streamがTrueなら、受信したWAVEデータのチャンクを順に返すイテレータを返す（計測する時間は受信を始めるまで）
+    @staticmethod
+    def synthesis(query_json, speaker_id, stream=False):
+        post_params = {"speaker": speaker_id}
+        with metrics.timer("voicevox.synthesis"):
+            response = VoicevoxAPI.session.post(f"{VoicevoxAPI.server}/synthesis", params=post_params, data=json.dumps(query_json), timeout=VoicevoxAPI.timeout, stream=stream)
+        if not stream:
+            response.raise_for_status()
+            return response.content
+
+        try:
+            response.raise_for_status()
+        except Exception:
+            response.close()
+            raise
+        return VoicevoxAPI._iter_content(response)
+
+    # 複数の音声データをまとめて生成する（エンジンがmulti_synthesisに対応していなければNone）
     @staticmethod
-    def synthesis(query_json, speaker_id):
+    def multi_synthesis(query_jsons, speaker_id):
         post_params = {"speaker": speaker_id}
-        response = requests.post(f"{VoicevoxAPI.server}/synthesis", params=post_params, data=json.dumps(query_json))
+        with metrics.timer("voicevox.multi_synthesis"):
+            response = VoicevoxAPI.session.post(f"{VoicevoxAPI.server}/multi_synthesis", params=post_params, data=json.dumps(query_jsons), timeout=VoicevoxAPI.timeout)
+        if response.status_code == 404:
+            return None
         response.raise_for_status()
-        return response.content
+        with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+            return [archive.read(name) for name in sorted(archive.namelist())]
+
+    # 複数の文の音声データを生成して、ひとつのWAVEデータにつなげる
+    # 読み上げ用データは同時に取得し、音声はmulti_synthesisでまとめて（使えなければ同時に）生成する
+    @staticmethod
+    def synthesis_batch(texts, speaker_id, speed_scale=1.0, pitch_scale=0.0):
+        with ThreadPoolExecutor(max_workers=max(VoicevoxAPI.batch_concurrency, 1)) as executor:
+            query_jsons = list(executor.map(lambda text: VoicevoxAPI.audio_query(text, speaker_id), texts))
+            for query_json in query_jsons:
+                query_json["speedScale"] = speed_scale
+                query_json["pitchScale"] = pitch_scale
+
+            wave_list = VoicevoxAPI.multi_synthesis(query_jsons, speaker_id)
+            if wave_list is None:
+                wave_list = list(executor.map(lambda query_json: VoicevoxAPI.synthesis(query_json, speaker_id), query_jsons))
+
+        return VoicevoxAPI._join_waves(wave_list)
+
+    # 複数のWAVEデータをつなげる
+    @staticmethod
+    def _join_waves(wave_list):
+        output = io.BytesIO()
+        with wave.open(output, "wb") as writer:
+            for index, wave_data in enumerate(wave_list):
+                with wave.open(io.BytesIO(wave_data), "rb") as reader:
+                    if index == 0:
+                        writer.setparams(reader.getparams())
+                    writer.writeframes(reader.readframes(reader.getnframes()))
+        return output.getvalue()
+
+    # レスポンスのデータをチャンクごとに返す
+    @staticmethod
+    def _iter_content(response):
+        with response:
+            yield from response.iter_content(chunk_size=VoicevoxAPI.STREAM_CHUNK_SIZE)